@@ -15,6 +15,7 @@
 
 
 mkdir -p ./build
+rsync -arvp "./src"/ ./build/
 rsync -arvp "../confusion_matrix/src"/ ./build/
 rsync -arvp "../roc/src"/ ./build/
 
@@ -0,0 +1,89 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Reads the prediction shards of a predict step for the metrics steps.
+# Shards are read concurrently by a thread pool, a window of num_threads
+# shards at a time, and handed out in file order, so at most num_threads
+# shards are in memory at once. Only the requested columns are parsed, and
+# NUMBER columns of the schema as floats.
+
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+from tensorflow.python.lib.io import file_io
+
+DEFAULT_NUM_THREADS = 8
+
+
+def read_schema(predictions):
+  """Returns the schema.json next to the prediction files."""
+  schema_file = os.path.join(os.path.dirname(predictions), 'schema.json')
+  return json.loads(file_io.read_file_to_string(schema_file))
+
+
+def _read_shard(path, names, usecols, dtype):
+  with file_io.FileIO(path, 'r') as f:
+    return pd.read_csv(f, names=names, usecols=usecols, dtype=dtype)
+
+
+def iter_predictions(predictions, schema, columns=None, num_threads=DEFAULT_NUM_THREADS):
+  """Yields a DataFrame per prediction shard, in file order.
+
+  Args:
+    predictions: file pattern of the prediction shards.
+    schema: the prediction schema, a list of {'name': ..., 'type': ...}.
+    columns: names of the columns to read, None to read all of them.
+    num_threads: number of shards read concurrently.
+  """
+  names = [x['name'] for x in schema]
+  usecols = [x for x in names if x in columns] if columns is not None else None
+  dtype = dict((x['name'], np.float64) for x in schema
+               if x['type'] == 'NUMBER' and (usecols is None or x['name'] in usecols))
+  files = file_io.get_matching_files(predictions)
+  if not files:
+    raise ValueError('No prediction files match "%s".' % predictions)
+  pool = ThreadPool(max(1, min(num_threads, len(files))))
+  try:
+    for start in range(0, len(files), num_threads):
+      window = files[start:start + num_threads]
+      for df in pool.map(lambda path: _read_shard(path, names, usecols, dtype), window):
+        yield df
+  finally:
+    pool.close()
+    pool.join()
+
+
+def reduce_predictions(predictions, schema, fn, initial, columns=None,
+                       num_threads=DEFAULT_NUM_THREADS):
+  """Folds fn(accumulator, df) over the prediction shards, without holding
+  more than a window of shards in memory."""
+  accumulator = initial
+  for df in iter_predictions(predictions, schema, columns, num_threads):
+    accumulator = fn(accumulator, df)
+  return accumulator
+
+
+def read_predictions(predictions, schema, columns=None, num_threads=DEFAULT_NUM_THREADS,
+                     transform=None):
+  """Returns the requested columns of all the prediction shards as one
+  DataFrame, after applying transform to each shard when given."""
+  dfs = [transform(df) if transform else df
+         for df in iter_predictions(predictions, schema, columns, num_threads)]
+  if len(dfs) == 1:
+    return dfs[0]
+  return pd.concat(dfs, ignore_index=True)
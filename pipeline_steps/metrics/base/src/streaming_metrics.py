@@ -0,0 +1,225 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Metrics accumulated over chunks of predictions in one pass, with memory
+# independent of the number of predictions.
+
+import numpy as np
+import pandas as pd
+
+
+class ConfusionMatrixAccumulator(object):
+  """Counts (target, predicted) label pairs of prediction chunks.
+
+  Labels are mapped to indices of a dense count matrix through a dictionary,
+  so memory is O(labels^2). The vocabulary is the target labels in order of
+  first appearance, as df['target'].unique() of all the chunks would give.
+  """
+
+  def __init__(self):
+    self._index = {}
+    self._counts = np.zeros((0, 0), dtype=np.int64)
+    self._is_target = set()
+    self.vocab = []
+    self.total = 0
+
+  def _encode(self, values):
+    """Returns the labels of a chunk in order of first appearance, and the
+    label index of every value, -1 for missing values."""
+    codes, uniques = pd.factorize(np.asarray(values))
+    mapping = np.empty(len(uniques) + 1, dtype=np.int64)
+    mapping[-1] = -1
+    for i, label in enumerate(uniques):
+      mapping[i] = self._index.setdefault(label, len(self._index))
+    # Code -1 of missing values picks the trailing -1.
+    return uniques, mapping[codes]
+
+  def update(self, target, predicted):
+    """Adds a chunk of target and predicted labels."""
+    target_labels, target_codes = self._encode(target)
+    _, predicted_codes = self._encode(predicted)
+    for label in target_labels:
+      if label not in self._is_target:
+        self._is_target.add(label)
+        self.vocab.append(label)
+
+    n = len(self._index)
+    if n > len(self._counts):
+      counts = np.zeros((n, n), dtype=np.int64)
+      counts[:len(self._counts), :len(self._counts)] = self._counts
+      self._counts = counts
+
+    valid = (target_codes >= 0) & (predicted_codes >= 0)
+    pairs = target_codes[valid] * n + predicted_codes[valid]
+    self._counts += np.bincount(pairs, minlength=n * n).reshape(n, n)
+    self.total += len(target_codes)
+
+  def matrix(self):
+    """Returns the counts of the vocab x vocab (target, predicted) pairs."""
+    indices = [self._index[label] for label in self.vocab]
+    return self._counts[np.ix_(indices, indices)]
+
+  def accuracy(self):
+    """Returns the fraction of predictions equal to their target."""
+    return float(np.trace(self._counts)) / self.total if self.total else 0.0
+
+
+class BinnedRocAccumulator(object):
+  """Counts positive and negative examples per score bin.
+
+  Scores are bucketed into num_bins equal bins of [low, high], scores outside
+  the range falling into the first or last bin, so memory is O(num_bins)
+  whatever the number of predictions, and the curve has at most num_bins + 1
+  points. Examples of the same bin are tied: the AUC of the binned curve
+  differs from the exact one by at most auc_error_bound().
+  """
+
+  def __init__(self, num_bins=1000, low=0.0, high=1.0):
+    if num_bins < 1:
+      raise ValueError('num_bins must be positive, got %d.' % num_bins)
+    if not high > low:
+      raise ValueError('Empty score range [%s, %s].' % (low, high))
+    self.num_bins = num_bins
+    self.low = float(low)
+    self.high = float(high)
+    self._positives = np.zeros(num_bins, dtype=np.int64)
+    self._negatives = np.zeros(num_bins, dtype=np.int64)
+
+  def update(self, target, scores):
+    """Adds a chunk of binary targets and positive class scores. Examples
+    with a missing score are ignored."""
+    target = np.asarray(target).astype(bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    valid = ~np.isnan(scores)
+    target, scores = target[valid], scores[valid]
+    bins = np.floor((scores - self.low) / (self.high - self.low) * self.num_bins)
+    bins = np.clip(bins, 0, self.num_bins - 1).astype(np.int64)
+    self._positives += np.bincount(bins[target], minlength=self.num_bins)
+    self._negatives += np.bincount(bins[~target], minlength=self.num_bins)
+
+  def _totals(self):
+    positives, negatives = self._positives.sum(), self._negatives.sum()
+    if not positives or not negatives:
+      raise ValueError('ROC AUC is not defined without both positive and negative examples.')
+    return float(positives), float(negatives)
+
+  def threshold_counts(self):
+    """Returns the ThresholdCounts of the binned scores. The threshold of a
+    point is the lower edge of its bin. Empty bins add no point."""
+    self._totals()
+    nonempty = np.flatnonzero(self._positives + self._negatives)[::-1]
+    width = (self.high - self.low) / self.num_bins
+    # The first point, above every score, has no example predicted positive.
+    thresholds = np.concatenate([[self.high + width], self.low + nonempty * width])
+    tps = np.concatenate([[0], np.cumsum(self._positives[nonempty])])
+    fps = np.concatenate([[0], np.cumsum(self._negatives[nonempty])])
+    return ThresholdCounts(tps, fps, thresholds)
+
+  def curve(self):
+    """Returns fpr, tpr and thresholds arrays of the binned curve, by
+    decreasing threshold as sklearn roc_curve does."""
+    return self.threshold_counts().roc_curve()
+
+  def auc(self):
+    """Returns the area under the binned curve, by the trapezoidal rule."""
+    positives, negatives = self._totals()
+    pos, neg = self._positives[::-1], self._negatives[::-1]
+    positives_above = np.cumsum(pos) - pos
+    return float(np.sum(neg * (positives_above + pos / 2.0))) / (positives * negatives)
+
+  def auc_error_bound(self):
+    """Returns the largest possible difference between auc() and the exact
+    AUC: half the fraction of (positive, negative) pairs tied in a bin."""
+    positives, negatives = self._totals()
+    tied = np.sum(self._positives.astype(np.float64) * self._negatives)
+    return tied / (2 * positives * negatives)
+
+
+class ThresholdCounts(object):
+  """Numbers of positive and negative examples scored at or above each of a
+  decreasing sequence of thresholds, from which every threshold-sweep metric
+  is derived without another pass over the predictions.
+
+  The first threshold is above every score, so the counts start at 0, and
+  the last counts are the totals.
+  """
+
+  def __init__(self, tps, fps, thresholds):
+    self.tps = np.asarray(tps, dtype=np.float64)
+    self.fps = np.asarray(fps, dtype=np.float64)
+    self.thresholds = np.asarray(thresholds, dtype=np.float64)
+    self.positives = self.tps[-1]
+    self.negatives = self.fps[-1]
+    if not self.positives or not self.negatives:
+      raise ValueError('Threshold metrics are not defined without both positive and negative examples.')
+
+  @classmethod
+  def from_scores(cls, target, scores):
+    """Returns the exact counts at every distinct score, like the internal
+    curve of sklearn roc_curve before intermediate points are dropped."""
+    target = np.asarray(target).astype(bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(scores, kind='mergesort')[::-1]
+    scores, target = scores[order], target[order]
+    # Index of the last example of each distinct score.
+    last = np.concatenate([np.flatnonzero(np.diff(scores)), [len(scores) - 1]])
+    tps = np.cumsum(target)[last]
+    fps = (last + 1) - tps
+    thresholds = np.concatenate([[scores[0] + 1], scores[last]])
+    return cls(np.concatenate([[0], tps]), np.concatenate([[0], fps]), thresholds)
+
+  def roc_curve(self, drop_intermediate=False):
+    """Returns the fpr, tpr and thresholds arrays of the ROC curve. With
+    drop_intermediate, points on a straight line between their neighbours
+    are left out, as sklearn roc_curve does."""
+    points = np.arange(len(self.thresholds))
+    if drop_intermediate and len(points) > 2:
+      corners = np.logical_or(np.diff(self.fps[1:], 2), np.diff(self.tps[1:], 2))
+      points = np.concatenate([[0, 1], 2 + np.flatnonzero(corners), [len(points) - 1]])
+    return (self.fps[points] / self.negatives, self.tps[points] / self.positives,
+            self.thresholds[points])
+
+  def roc_auc(self):
+    """Returns the area under the ROC curve, by the trapezoidal rule, which
+    counts tied (positive, negative) pairs as half ordered."""
+    fpr, tpr, _ = self.roc_curve()
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+  def precision_recall_curve(self):
+    """Returns the precision, recall and thresholds arrays, without the
+    first point, where no example is predicted positive."""
+    predicted = self.tps[1:] + self.fps[1:]
+    return self.tps[1:] / predicted, self.tps[1:] / self.positives, self.thresholds[1:]
+
+  def average_precision(self):
+    """Returns the precision averaged over the recall steps, as sklearn
+    average_precision_score computes the area under the PR curve."""
+    precision, recall, _ = self.precision_recall_curve()
+    return float(np.sum(np.diff(np.concatenate([[0], recall])) * precision))
+
+  def best_f1(self):
+    """Returns the highest F1 score of the thresholds and its threshold."""
+    f1 = 2 * self.tps / (self.tps + self.fps + self.positives)
+    best = np.argmax(f1)
+    return float(f1[best]), float(self.thresholds[best])
+
+  def lift(self, num_groups=10):
+    """Returns the fraction of the population, gain and lift of the top
+    1/num_groups, 2/num_groups, ... of the examples by score. Counts within
+    a threshold are interpolated linearly."""
+    fractions = np.arange(1, num_groups + 1) / float(num_groups)
+    population = self.tps + self.fps
+    gain = np.interp(fractions * population[-1], population, self.tps) / self.positives
+    return fractions, gain, gain / fractions
@@ -0,0 +1,174 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Evaluates the --target_lambda of the metrics steps over whole columns.
+# A lambda made of column references, constants, comparisons, arithmetic and
+# and/or/not, like "lambda x: x['target']" or "lambda x: x['a'] > 0.5 and
+# not x['b']", is compiled to pandas operations over the DataFrame. Any
+# other lambda is applied row by row, as before. Both evaluate / as true
+# division, also in Python 2.
+
+import __future__
+import ast
+import operator
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+_CONSTANT_TYPES = tuple(getattr(ast, name) for name in ('Constant', 'Num', 'Str', 'NameConstant')
+                        if hasattr(ast, name))
+
+_BINARY_OPERATORS = {
+  ast.Add: operator.add,
+  ast.Sub: operator.sub,
+  ast.Mult: operator.mul,
+  ast.Div: operator.truediv,
+  ast.Mod: operator.mod,
+}
+
+_COMPARE_OPERATORS = {
+  ast.Eq: operator.eq,
+  ast.NotEq: operator.ne,
+  ast.Lt: operator.lt,
+  ast.LtE: operator.le,
+  ast.Gt: operator.gt,
+  ast.GtE: operator.ge,
+}
+
+
+class UnsupportedExpression(Exception):
+  """The lambda uses syntax that is not evaluated over columns."""
+
+
+def _truth(value):
+  return np.asarray(value).astype(bool)
+
+
+def _and(left, right):
+  # x and y is x when x is falsy, else y, element-wise.
+  return np.where(_truth(left), right, left)
+
+
+def _or(left, right):
+  return np.where(_truth(left), left, right)
+
+
+def _constant_value(node):
+  for field in ('value', 'n', 's'):
+    if hasattr(node, field):
+      return getattr(node, field)
+  raise UnsupportedExpression(ast.dump(node))
+
+
+def _subscript_key(node):
+  key = node.slice
+  # Python < 3.9 wraps the key in an Index node.
+  if isinstance(key, getattr(ast, 'Index', ())):
+    key = key.value
+  if not isinstance(key, _CONSTANT_TYPES):
+    raise UnsupportedExpression(ast.dump(node))
+  return _constant_value(key)
+
+
+class _Compiler(object):
+  """Compiles the body of a one argument lambda to a function of a
+  DataFrame, recording the columns it reads."""
+
+  def __init__(self, arg_name):
+    self.arg_name = arg_name
+    self.columns = []
+
+  def compile(self, node):
+    if isinstance(node, _CONSTANT_TYPES):
+      value = _constant_value(node)
+      return lambda df: value
+    if isinstance(node, ast.Name) and node.id in ('True', 'False'):
+      # Python 2 parses True and False as names.
+      value = node.id == 'True'
+      return lambda df: value
+    if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+        and node.value.id == self.arg_name):
+      column = _subscript_key(node)
+      if column not in self.columns:
+        self.columns.append(column)
+      return lambda df: df[column]
+    if isinstance(node, ast.BoolOp):
+      combine = _and if isinstance(node.op, ast.And) else _or
+      operands = [self.compile(x) for x in node.values]
+      return lambda df: reduce(combine, [f(df) for f in operands])
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+      operand = self.compile(node.operand)
+      return lambda df: ~_truth(operand(df))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+      operand = self.compile(node.operand)
+      return lambda df: -operand(df)
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+      fn = _BINARY_OPERATORS[type(node.op)]
+      left, right = self.compile(node.left), self.compile(node.right)
+      return lambda df: fn(left(df), right(df))
+    if isinstance(node, ast.Compare) and all(type(x) in _COMPARE_OPERATORS for x in node.ops):
+      fns = [_COMPARE_OPERATORS[type(x)] for x in node.ops]
+      operands = [self.compile(x) for x in [node.left] + node.comparators]
+      def compare(df):
+        values = [f(df) for f in operands]
+        # a < b < c is (a < b) and (b < c).
+        results = [np.asarray(fn(values[i], values[i + 1])) for i, fn in enumerate(fns)]
+        return reduce(operator.and_, results)
+      return compare
+    raise UnsupportedExpression(ast.dump(node))
+
+
+class TargetExpression(object):
+  """A --target_lambda, callable on a DataFrame to get the target Series.
+
+  Attributes:
+    vectorized: whether the lambda is evaluated over whole columns.
+    columns: the columns the lambda reads, None when it is applied row by
+      row and may read any column.
+  """
+
+  def __init__(self, text):
+    self.text = text
+    self.vectorized = False
+    self.columns = None
+    try:
+      self._fn, self.columns = self._compile(text)
+      self.vectorized = True
+    except (SyntaxError, UnsupportedExpression):
+      self._fn = eval(compile(text.strip(), '<target_lambda>', 'eval',
+                              __future__.division.compiler_flag))
+
+  @staticmethod
+  def _compile(text):
+    node = ast.parse(text.strip(), mode='eval').body
+    if not isinstance(node, ast.Lambda):
+      raise UnsupportedExpression(text)
+    args = node.args
+    if len(args.args) != 1 or args.vararg or args.kwarg or args.defaults:
+      raise UnsupportedExpression(text)
+    # The argument is a Name in Python 2 and an arg in Python 3.
+    arg_name = getattr(args.args[0], 'arg', None) or getattr(args.args[0], 'id', None)
+    compiler = _Compiler(arg_name)
+    return compiler.compile(node.body), compiler.columns
+
+  def __call__(self, df):
+    if not self.vectorized:
+      return df.apply(self._fn, axis=1)
+    result = self._fn(df)
+    if isinstance(result, pd.Series):
+      return result
+    # Arrays of and/or/not, and constants, which broadcast to every row.
+    return pd.Series(result, index=df.index)
@@ -0,0 +1,139 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from streaming_metrics import BinnedRocAccumulator, ConfusionMatrixAccumulator, ThresholdCounts
+import numpy as np
+import unittest
+
+
+class TestConfusionMatrixAccumulator(unittest.TestCase):
+
+  def test_chunks(self):
+    """Test counts and vocab order over several chunks"""
+
+    accumulator = ConfusionMatrixAccumulator()
+    accumulator.update(['b', 'a', 'b'], ['b', 'b', 'a'])
+    accumulator.update(['c', 'a'], ['c', 'a'])
+    self.assertEqual(accumulator.vocab, ['b', 'a', 'c'])
+    np.testing.assert_array_equal(accumulator.matrix(),
+                                  [[1, 1, 0], [1, 1, 0], [0, 0, 1]])
+    self.assertAlmostEqual(accumulator.accuracy(), 3 / 5.0)
+
+  def test_predicted_only_labels(self):
+    """Test predicted labels that are never a target are left out of the matrix"""
+
+    accumulator = ConfusionMatrixAccumulator()
+    accumulator.update([0, 1, 1], [0, 1, 2])
+    self.assertEqual(accumulator.vocab, [0, 1])
+    np.testing.assert_array_equal(accumulator.matrix(), [[1, 0], [0, 1]])
+    self.assertAlmostEqual(accumulator.accuracy(), 2 / 3.0)
+
+  def test_bool_predictions(self):
+    """Test boolean predictions match integer targets, as in the predict step output"""
+
+    accumulator = ConfusionMatrixAccumulator()
+    accumulator.update(np.array([0, 1, 1, 0]), np.array([False, True, False, False]))
+    np.testing.assert_array_equal(accumulator.matrix(), [[2, 0], [1, 1]])
+    self.assertAlmostEqual(accumulator.accuracy(), 0.75)
+
+
+class TestBinnedRocAccumulator(unittest.TestCase):
+
+  def _exact_auc(self, target, scores):
+    positives, negatives = scores[target == 1], scores[target == 0]
+    greater = (positives[:, np.newaxis] > negatives).sum()
+    ties = (positives[:, np.newaxis] == negatives).sum()
+    return (greater + ties / 2.0) / (len(positives) * len(negatives))
+
+  def test_auc_within_bound(self):
+    """Test the binned AUC of chunks is within its error bound of the exact AUC"""
+
+    rng = np.random.RandomState(0)
+    target = rng.randint(2, size=3000)
+    scores = 1 / (1 + np.exp(-(target + rng.randn(3000))))
+    accumulator = BinnedRocAccumulator(num_bins=20)
+    for i in range(0, 3000, 1000):
+      accumulator.update(target[i:i + 1000], scores[i:i + 1000])
+    exact = self._exact_auc(target, scores)
+    self.assertGreater(accumulator.auc_error_bound(), 0)
+    self.assertLessEqual(abs(accumulator.auc() - exact), accumulator.auc_error_bound())
+
+  def test_exact_when_bins_separate_scores(self):
+    """Test AUC and curve when no bin holds both classes"""
+
+    accumulator = BinnedRocAccumulator(num_bins=10)
+    accumulator.update([0, 1, 0, 1, 0], [0.05, 0.35, 0.45, 0.95, np.nan])
+    self.assertEqual(accumulator.auc_error_bound(), 0)
+    self.assertAlmostEqual(accumulator.auc(), 0.75)
+    fpr, tpr, thresholds = accumulator.curve()
+    np.testing.assert_allclose(fpr, [0, 0, 0.5, 0.5, 1])
+    np.testing.assert_allclose(tpr, [0, 0.5, 0.5, 1, 1])
+    np.testing.assert_allclose(thresholds, [1.1, 0.9, 0.4, 0.3, 0])
+
+  def test_single_class(self):
+    """Test AUC is undefined without negatives"""
+
+    accumulator = BinnedRocAccumulator()
+    accumulator.update([1, 1], [0.2, 0.8])
+    self.assertRaises(ValueError, accumulator.auc)
+
+
+class TestThresholdCounts(unittest.TestCase):
+
+  def setUp(self):
+    # Scores by decreasing value: 0.9 (+), 0.8 (-), 0.6 (+, -), 0.3 (+), 0.1 (-)
+    self.counts = ThresholdCounts.from_scores(
+        [0, 1, 1, 0, 1, 0], [0.8, 0.9, 0.6, 0.6, 0.3, 0.1])
+
+  def test_from_scores(self):
+    """Test counts at every distinct score, ties grouped"""
+
+    np.testing.assert_array_equal(self.counts.tps, [0, 1, 1, 2, 3, 3])
+    np.testing.assert_array_equal(self.counts.fps, [0, 0, 1, 2, 2, 3])
+    np.testing.assert_allclose(self.counts.thresholds, [1.9, 0.9, 0.8, 0.6, 0.3, 0.1])
+
+  def test_roc(self):
+    """Test the ROC AUC counts ties as half ordered, and collinear points are dropped"""
+
+    self.assertAlmostEqual(self.counts.roc_auc(), 5.5 / 9)
+    fpr, tpr, _ = self.counts.roc_curve(drop_intermediate=True)
+    np.testing.assert_allclose(fpr * 3, [0, 0, 1, 2, 2, 3])
+    counts = ThresholdCounts.from_scores([1, 1, 1, 0], [0.9, 0.8, 0.7, 0.1])
+    fpr, tpr, _ = counts.roc_curve(drop_intermediate=True)
+    np.testing.assert_allclose(tpr, [0, 1 / 3.0, 1, 1])
+
+  def test_precision_recall(self):
+    """Test the PR curve, average precision and best F1"""
+
+    precision, recall, thresholds = self.counts.precision_recall_curve()
+    np.testing.assert_allclose(precision, [1, 0.5, 0.5, 0.6, 0.5])
+    np.testing.assert_allclose(recall * 3, [1, 1, 2, 3, 3])
+    self.assertAlmostEqual(self.counts.average_precision(), (1 + 0.5 + 0.6) / 3)
+    self.assertEqual(self.counts.best_f1(), (0.75, 0.3))
+
+  def test_lift(self):
+    """Test gain and lift of the top fractions of the examples, interpolated within ties"""
+
+    fractions, gain, lift = self.counts.lift(num_groups=2)
+    np.testing.assert_allclose(fractions, [0.5, 1])
+    np.testing.assert_allclose(gain, [0.5, 1])
+    np.testing.assert_allclose(lift, [1, 1])
+    fractions, gain, lift = self.counts.lift(num_groups=6)
+    np.testing.assert_allclose(gain[0], 1 / 3.0)
+    np.testing.assert_allclose(lift[0], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,80 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from target_expression import TargetExpression
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class TestTargetExpression(unittest.TestCase):
+
+  def setUp(self):
+    self.df = pd.DataFrame({
+      'target': [0, 1, 1, 0],
+      'score': [0.2, 0.9, 0.4, 0.7],
+      'flag': [True, False, True, True],
+      'label': ['a', 'b', 'a', 'c'],
+    })
+
+  def _assert_matches_apply(self, text):
+    expression = TargetExpression(text)
+    self.assertTrue(expression.vectorized)
+    np.testing.assert_array_equal(expression(self.df).values,
+                                  self.df.apply(eval(text), axis=1).values)
+    return expression
+
+  def test_column(self):
+    """Test a column reference reads only that column"""
+
+    expression = self._assert_matches_apply("lambda x: x['target']")
+    self.assertEqual(expression.columns, ['target'])
+
+  def test_boolean_expressions(self):
+    """Test and/or/not and comparisons give the values of the row lambda"""
+
+    self._assert_matches_apply("lambda x: x['score'] > 0.5 and not x['flag']")
+    self._assert_matches_apply("lambda x: x['target'] and x['score']")
+    self._assert_matches_apply("lambda x: x['label'] == 'a' or x['target']")
+    expression = self._assert_matches_apply("lambda row: 0.3 < row['score'] <= 0.8")
+    self.assertEqual(expression.columns, ['score'])
+
+  def test_arithmetic(self):
+    """Test arithmetic over columns and constants"""
+
+    expression = self._assert_matches_apply("lambda x: x['target'] * 2 - x['score'] / 2")
+    self.assertEqual(expression.columns, ['target', 'score'])
+
+  def test_row_fallback(self):
+    """Test other lambdas are applied row by row and may read any column"""
+
+    expression = TargetExpression("lambda x: 1 if x['flag'] else 0")
+    self.assertFalse(expression.vectorized)
+    self.assertIsNone(expression.columns)
+    self.assertEqual(expression(self.df).tolist(), [1, 0, 1, 1])
+
+  def test_division(self):
+    """Test / is true division of integers, over columns and row by row"""
+
+    vectorized = TargetExpression("lambda x: x['target'] / 2")
+    row = TargetExpression("lambda x: x['target'] / 2 if x['flag'] else x['target'] / 4")
+    self.assertTrue(vectorized.vectorized)
+    self.assertFalse(row.vectorized)
+    self.assertEqual(vectorized(self.df).tolist(), [0.0, 0.5, 0.5, 0.0])
+    self.assertEqual(row(self.df).tolist(), [0.0, 0.25, 0.5, 0.0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,76 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Compares applying a --target_lambda row by row, as the metrics steps used
+# to, with evaluating it over whole columns.
+# Usage:
+# python benchmark_target_expression.py --rows=1000000
+
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'base', 'src'))
+from target_expression import TargetExpression
+
+LAMBDAS = [
+  "lambda x: x['target']",
+  "lambda x: x['true'] > 0.5 and not x['predicted']",
+  "lambda x: x['target'] * 2 - x['true']",
+]
+
+
+def parse_arguments():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--rows', type=int, default=1000000,
+                      help='Number of rows of the generated predictions.')
+  return parser.parse_args()
+
+
+def timed(fn):
+  start = time.time()
+  result = fn()
+  return time.time() - start, result
+
+
+def main():
+  args = parse_arguments()
+  rng = np.random.RandomState(0)
+  true = rng.rand(args.rows)
+  df = pd.DataFrame({
+    'target': rng.randint(2, size=args.rows),
+    'predicted': true > 0.5,
+    'true': true,
+    'false': 1 - true,
+  })
+  print('%d rows' % len(df))
+  print('%-52s %10s %10s' % ('lambda', 'row (s)', 'column (s)'))
+  for text in LAMBDAS:
+    row_time, expected = timed(lambda: df.apply(eval(text), axis=1))
+    expression = TargetExpression(text)
+    column_time, result = timed(lambda: expression(df))
+    assert np.array_equal(np.asarray(result, dtype=float), np.asarray(expected, dtype=float))
+    print('%-52s %10.3f %10.3f' % (text, row_time, column_time))
+
+
+if __name__ == '__main__':
+  main()
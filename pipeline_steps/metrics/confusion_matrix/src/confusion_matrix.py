@@ -27,7 +27,9 @@ import json
 import os
 import urlparse
 import pandas as pd
-from sklearn.metrics import confusion_matrix, accuracy_score
+import prediction_io
+from streaming_metrics import ConfusionMatrixAccumulator
+from target_expression import TargetExpression
 from tensorflow.python.lib.io import file_io
 
 
@@ -46,21 +48,22 @@ def main(argv=None):
   if not on_cloud and not os.path.exists(args.output):
     os.makedirs(args.output)
 
-  schema_file = os.path.join(os.path.dirname(args.predictions), 'schema.json')
-  schema = json.loads(file_io.read_file_to_string(schema_file))
-  names = [x['name'] for x in schema]
-  dfs = []
-  files = file_io.get_matching_files(args.predictions)
-  for file in files:
-    with file_io.FileIO(file, 'r') as f:
-      dfs.append(pd.read_csv(f, names=names))
+  schema = prediction_io.read_schema(args.predictions)
 
-  df = pd.concat(dfs)
-  if args.target_lambda:
-    df['target'] = df.apply(eval(args.target_lambda), axis=1)
+  # Only the columns of the target lambda are read, or all of them when it is
+  # applied row by row.
+  columns = ['target', 'predicted']
+  target = TargetExpression(args.target_lambda) if args.target_lambda else None
+  if target:
+    columns = target.columns + ['predicted'] if target.vectorized else None
+  accumulator = ConfusionMatrixAccumulator()
+  for df in prediction_io.iter_predictions(args.predictions, schema, columns):
+    if target:
+      df['target'] = target(df)
+    accumulator.update(df['target'], df['predicted'])
 
-  vocab = list(df['target'].unique())
-  cm = confusion_matrix(df['target'], df['predicted'], labels=vocab)
+  vocab = accumulator.vocab
+  cm = accumulator.matrix()
   data = []
   for target_index, target_row in enumerate(cm):
     for predicted_index, count in enumerate(target_row):
@@ -88,7 +91,7 @@ def main(argv=None):
   with file_io.FileIO('/mlpipeline-ui-metadata.json', 'w') as f:
     json.dump(metadata, f)
 
-  accuracy = accuracy_score(df['target'], df['predicted'])
+  accuracy = accumulator.accuracy()
   metrics = {
     'metrics': [{
       'name': 'accuracy-score',
@@ -19,16 +19,38 @@
 #   --predictions=gs://bradley-playground/sfpd/predictions/part-* \
 #   --trueclass=ACTION \
 #   --output=gs://bradley-playground/sfpd/roc/ \
+#   --num_bins=1000 \
+#   --metrics=roc,pr,f1,lift
 
 
 import argparse
 import json
+import logging
 import os
 import urlparse
+import numpy as np
 import pandas as pd
-from sklearn.metrics import roc_curve, roc_auc_score
+import prediction_io
+from streaming_metrics import BinnedRocAccumulator, ThresholdCounts
+from target_expression import TargetExpression
 from tensorflow.python.lib.io import file_io
 
+METRICS = ['roc', 'pr', 'f1', 'lift']
+# The exact PR curve has a point per distinct score, it is written evenly
+# down-sampled to this many points.
+MAX_PR_POINTS = 1000
+
+
+def write_table(df, path):
+  with file_io.FileIO(path, 'w') as f:
+    df.to_csv(f, columns=list(df.columns), header=False, index=False)
+  return {
+    'type': 'table',
+    'format': 'csv',
+    'header': list(df.columns),
+    'source': path,
+  }
+
 
 def main(argv=None):
   parser = argparse.ArgumentParser(description='ML Trainer')
@@ -43,16 +65,26 @@ def main(argv=None):
                       help='a lambda function as a string to determine positive or negative.' +
                            'For example, "lambda x: x[\'a\'] and x[\'b\']". If missing, ' +
                            'input must have a "target" column.')
+  parser.add_argument('--num_bins', type=int, default=0,
+                      help='Number of equal score bins of [0, 1] the ROC curve is computed over, ' +
+                           'in one pass and constant memory, writing at most num_bins + 1 ' +
+                           'points. 0 computes the exact curve of all the predictions.')
+  parser.add_argument('--metrics', type=str, default='roc',
+                      help='Comma separated metrics computed in the same pass over the ' +
+                           'predictions, out of %s. roc is always computed.' % ','.join(METRICS))
   parser.add_argument('--output', type=str, help='GCS path of the output directory.')
   args = parser.parse_args()
+  requested = set(x.strip() for x in args.metrics.split(',') if x.strip())
+  if requested - set(METRICS):
+    raise ValueError('Unknown metrics %s, expected some of %s.' %
+                     (','.join(sorted(requested - set(METRICS))), ','.join(METRICS)))
 
   storage_service_scheme = urlparse.urlparse(args.output).scheme
   on_cloud = True if storage_service_scheme else False
   if not on_cloud and not os.path.exists(args.output):
     os.makedirs(args.output)
 
-  schema_file = os.path.join(os.path.dirname(args.predictions), 'schema.json')
-  schema = json.loads(file_io.read_file_to_string(schema_file))
+  schema = prediction_io.read_schema(args.predictions)
   names = [x['name'] for x in schema]
 
   if not args.target_lambda and 'target' not in names:
@@ -61,47 +93,82 @@ def main(argv=None):
   if args.true_score_column not in names:
     raise ValueError('Cannot find column name "%s"' % args.true_score_column)
 
-  dfs = []
-  files = file_io.get_matching_files(args.predictions)
-  for file in files:
-    with file_io.FileIO(file, 'r') as f:
-      dfs.append(pd.read_csv(f, names=names))
+  target = TargetExpression(args.target_lambda) if args.target_lambda else None
+
+  def get_target(df):
+    if target:
+      df['target'] = target(df)
+    else:
+      df['target'] = df['target'].apply(lambda x: 1 if x == args.trueclass else 0)
+    return df[['target', args.true_score_column]]
 
-  df = pd.concat(dfs)
-  if args.target_lambda:
-    df['target'] = df.apply(eval(args.target_lambda), axis=1)
+  # Only the columns of the target lambda are read, or all of them when it is
+  # applied row by row.
+  columns = ['target', args.true_score_column]
+  if target:
+    columns = target.columns + [args.true_score_column] if target.vectorized else None
+  if args.num_bins:
+    accumulator = BinnedRocAccumulator(args.num_bins)
+    for df in prediction_io.iter_predictions(args.predictions, schema, columns):
+      df = get_target(df)
+      accumulator.update(df['target'], df[args.true_score_column])
+    counts = accumulator.threshold_counts()
+    fpr, tpr, thresholds = counts.roc_curve()
+    roc_auc = accumulator.auc()
+    logging.info('ROC AUC %f computed over %d bins, within %f of the exact AUC.',
+                 roc_auc, args.num_bins, accumulator.auc_error_bound())
   else:
-    df['target'] = df['target'].apply(lambda x: 1 if x == args.trueclass else 0)
-  fpr, tpr, thresholds = roc_curve(df['target'], df[args.true_score_column])
-  roc_auc = roc_auc_score(df['target'], df[args.true_score_column])
+    df = prediction_io.read_predictions(args.predictions, schema, columns, transform=get_target)
+    counts = ThresholdCounts.from_scores(df['target'], df[args.true_score_column])
+    fpr, tpr, thresholds = counts.roc_curve(drop_intermediate=True)
+    roc_auc = counts.roc_auc()
   df_roc = pd.DataFrame({'fpr': fpr, 'tpr': tpr, 'thresholds': thresholds})
   roc_file = os.path.join(args.output, 'roc.csv')
   with file_io.FileIO(roc_file, 'w') as f:
     df_roc.to_csv(f, columns=['fpr', 'tpr', 'thresholds'], header=False, index=False)
 
-  metadata = {
-    'outputs': [{
-      'type': 'roc',
-      'format': 'csv',
-      'schema': [
-        {'name': 'fpr', 'type': 'NUMBER'},
-        {'name': 'tpr', 'type': 'NUMBER'},
-        {'name': 'thresholds', 'type': 'NUMBER'},
-      ],
-      'source': roc_file
-    }]
-  }
+  outputs = [{
+    'type': 'roc',
+    'format': 'csv',
+    'schema': [
+      {'name': 'fpr', 'type': 'NUMBER'},
+      {'name': 'tpr', 'type': 'NUMBER'},
+      {'name': 'thresholds', 'type': 'NUMBER'},
+    ],
+    'source': roc_file
+  }]
+  metrics = [{
+    'name': 'roc-auc-score',
+    'numberValue':  roc_auc,
+  }]
+
+  if 'pr' in requested:
+    precision, recall, pr_thresholds = counts.precision_recall_curve()
+    points = np.unique(np.linspace(0, len(precision) - 1, MAX_PR_POINTS).astype(int))
+    df_pr = pd.DataFrame({'recall': recall[points], 'precision': precision[points],
+                          'thresholds': pr_thresholds[points]},
+                         columns=['recall', 'precision', 'thresholds'])
+    outputs.append(write_table(df_pr, os.path.join(args.output, 'pr.csv')))
+    metrics.append({'name': 'pr-auc-score', 'numberValue': counts.average_precision()})
+
+  if 'f1' in requested:
+    f1, f1_threshold = counts.best_f1()
+    metrics.append({'name': 'best-f1-score', 'numberValue': f1})
+    metrics.append({'name': 'best-f1-threshold', 'numberValue': f1_threshold})
+
+  if 'lift' in requested:
+    fractions, gain, lift = counts.lift()
+    df_lift = pd.DataFrame({'population': fractions, 'gain': gain, 'lift': lift},
+                           columns=['population', 'gain', 'lift'])
+    outputs.append(write_table(df_lift, os.path.join(args.output, 'lift.csv')))
+    metrics.append({'name': 'top-decile-lift', 'numberValue': float(lift[0])})
+
   with file_io.FileIO('/mlpipeline-ui-metadata.json', 'w') as f:
-    json.dump(metadata, f)
+    json.dump({'outputs': outputs}, f)
 
-  metrics = {
-    'metrics': [{
-      'name': 'roc-auc-score',
-      'numberValue':  roc_auc,
-    }]
-  }
   with file_io.FileIO('/mlpipeline-metrics.json', 'w') as f:
-    json.dump(metrics, f)
+    json.dump({'metrics': metrics}, f)
 
 if __name__== "__main__":
+  logging.getLogger().setLevel(logging.INFO)
   main()
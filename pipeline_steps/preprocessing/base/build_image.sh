@@ -15,6 +15,7 @@
 
 
 mkdir -p ./build
+rsync -arvp "./src"/ ./build/
 rsync -arvp "../tfdv/src"/ ./build/
 rsync -arvp "../tft/src"/ ./build/
 rsync -arvp "../tfma/src"/ ./build/
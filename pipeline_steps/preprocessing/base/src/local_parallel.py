@@ -0,0 +1,87 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Runs the Beam pipelines of the preprocessing steps on all the CPUs the
+# container may use, for the "local-parallel" run mode.
+# The DirectRunner of the Beam releases in the images runs in a single
+# process, so the input is split in shards that run as separate pipelines,
+# one process each, writing their own output files.
+
+import multiprocessing
+import zlib
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+
+def _read_cgroup_quota():
+  """Returns the CPU quota and period of the container's cgroup, or None if
+  no quota is set."""
+  try:
+    with open(CGROUP_V2_CPU_MAX) as f:
+      quota, period = f.read().split()
+    if quota == 'max':
+      return None
+    return int(quota), int(period)
+  except (IOError, OSError, ValueError):
+    pass
+  try:
+    with open(CGROUP_V1_CPU_QUOTA) as f:
+      quota = int(f.read())
+    with open(CGROUP_V1_CPU_PERIOD) as f:
+      period = int(f.read())
+  except (IOError, OSError, ValueError):
+    return None
+  if quota <= 0:
+    return None
+  return quota, period
+
+
+def get_cpu_limit():
+  """Returns the number of CPUs the container may use: its cgroup CPU quota
+  rounded up, bounded by the CPUs of the machine."""
+  cpus = multiprocessing.cpu_count()
+  quota = _read_cgroup_quota()
+  if quota is None:
+    return cpus
+  quota, period = quota
+  return max(1, min(cpus, -(-quota // period)))
+
+
+def in_shard(line, shard_index, num_shards):
+  """Returns whether the line belongs to the given shard. Lines are spread
+  on their hash so that every process sees the same split."""
+  if not isinstance(line, bytes):
+    line = line.encode('utf-8')
+  return (zlib.crc32(line) & 0xffffffff) % num_shards == shard_index
+
+
+def run_sharded(target, num_workers=0):
+  """Calls target(shard_index, num_shards) in num_workers processes, or in one
+  process per CPU of the container when num_workers is 0, and waits for all
+  of them. Returns the number of shards.
+  Raises RuntimeError if any of the processes failed."""
+  num_workers = num_workers or get_cpu_limit()
+  processes = [multiprocessing.Process(target=target, args=(i, num_workers))
+               for i in range(num_workers)]
+  for process in processes:
+    process.start()
+  for process in processes:
+    process.join()
+  failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+  if failed:
+    raise RuntimeError('Shards %s of %d failed.' % (failed, num_workers))
+  return num_workers
@@ -0,0 +1,117 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Measures the elements/sec of the Beam predict pipeline on the DirectRunner.
+# Run it in the tf-predict image, which has apache-beam 2.5.0, so that the
+# numbers are those of the step: the DirectRunner and BatchElements differ
+# between Beam releases. The release measured is printed with the result.
+# Compare two versions of the step by pointing --src at each, e.g. the one
+# before batching with BatchElements:
+# git show <rev>:pipeline_steps/preprocessing/predict/src/predict.py > /tmp/predict_before.py
+# python benchmark_predict.py \
+#   --src=/tmp/predict_before.py \
+#   --data=gs://kubeflow-pipelines-demo/dataset/test.csv \
+#   --schema=gs://kubeflow-pipelines-demo/dataset/schema.json \
+#   --target=target \
+#   --model=gs://bradley-playground/santander/model/export/export/1551234567
+# python benchmark_predict.py --data=... --schema=... --target=target --model=...
+
+
+from __future__ import print_function
+
+import argparse
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import apache_beam as beam
+from tensorflow.python.lib.io import file_io
+
+# predict.py imports the modules of the base image.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'base', 'src'))
+
+
+def parse_arguments():
+  """Parse command line arguments."""
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--src',
+                      type=str,
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           '..', 'src', 'predict.py'),
+                      help='Path of the predict.py to measure, the current one by default.')
+  parser.add_argument('--data',
+                      type=str,
+                      required=True,
+                      help='GCS or local path of test file patterns.')
+  parser.add_argument('--schema',
+                      type=str,
+                      required=True,
+                      help='GCS or local json schema file path.')
+  parser.add_argument('--target',
+                      type=str,
+                      required=True,
+                      help='Name of the column for prediction target.')
+  parser.add_argument('--model',
+                      type=str,
+                      required=True,
+                      help='GCS or local path of an exported model directory.')
+  parser.add_argument('--batchsize',
+                      type=int,
+                      default=1024,
+                      help='Batch size passed to run_predict.')
+  parser.add_argument('--repeats',
+                      type=int,
+                      default=3,
+                      help='Number of runs, the best one is reported.')
+  return parser.parse_args()
+
+
+def count_lines(data_path):
+  count = 0
+  for path in file_io.get_matching_files(data_path):
+    with file_io.FileIO(path, 'r') as f:
+      count += sum(1 for _ in f)
+  return count
+
+
+def main():
+  args = parse_arguments()
+  predict = imp.load_source('predict_under_test', args.src)
+  schema = json.loads(file_io.read_file_to_string(args.schema))
+  elements = count_lines(args.data)
+
+  times = []
+  for _ in range(args.repeats):
+    output_dir = tempfile.mkdtemp()
+    try:
+      start = time.time()
+      predict.run_predict(output_dir, args.data, schema, args.target, args.model,
+                          None, 'local', args.batchsize)
+      times.append(time.time() - start)
+    finally:
+      shutil.rmtree(output_dir)
+
+  best = min(times)
+  print('%s: %d elements in %.3f s, %.1f elements/sec (apache-beam %s)' %
+        (args.src, elements, best, elements / best, beam.__version__))
+
+
+if __name__ == '__main__':
+  main()
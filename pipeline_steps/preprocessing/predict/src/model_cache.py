@@ -0,0 +1,36 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Models loaded by this worker process, shared by the PredictDoFn instances of
+# all its bundles and threads. The cache lives in its own module, installed on
+# Dataflow workers by setup.py, so it is imported rather than pickled with the
+# DoFn.
+
+import threading
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(key, load_fn, on_load=None):
+  """Returns the model cached under key, calling load_fn to load it the
+  first time, and on_load after it was loaded. Threads asking for a model
+  being loaded wait for it instead of loading it again."""
+  with _models_lock:
+    if key not in _models:
+      _models[key] = load_fn()
+      if on_load is not None:
+        on_load()
+    return _models[key]
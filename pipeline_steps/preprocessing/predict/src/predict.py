@@ -17,13 +17,19 @@
 
 import apache_beam as beam
 import argparse
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
 from apache_beam.options.pipeline_options import PipelineOptions
 import datetime
 import json
+import local_parallel
 import logging
 import os
 from tensorflow.python.lib.io import file_io
 
+# Signature of models exported with a dense float32 tensor input.
+TENSOR_SIGNATURE_KEY = 'tensor:predict'
+
 
 def parse_arguments():
   """Parse command line arguments."""
@@ -54,104 +60,132 @@ def parse_arguments():
                       required=True,
                       help='The GCP project to run the dataflow job.')
   parser.add_argument('--mode',
-                      choices=['local', 'cloud'],
-                      help='whether to run the job locally or in Cloud Dataflow.')
+                      choices=['local', 'local-parallel', 'cloud'],
+                      help='whether to run the job locally, locally on all the CPUs of the ' +
+                           'container, or in Cloud Dataflow.')
+  parser.add_argument('--num-workers',
+                      type=int,
+                      default=0,
+                      help='Number of worker processes in local-parallel mode. 0 uses every ' +
+                           'CPU the container may use.')
   parser.add_argument('--batchsize',
                       type=int,
-                      default=32,
-                      help='Batch size used in prediction.')
+                      default=1024,
+                      help='Maximum batch size used in prediction, batches are sized adaptively up to it.')
 
   args = parser.parse_args()
   return args
 
 
-class EmitAsBatchDoFn(beam.DoFn):
-  """A DoFn that buffers the records and emits them batch by batch."""
-
-  def __init__(self, batch_size):
-    self._batch_size = batch_size
-    self._cached = []
-
-  def process(self, element):
-    from apache_beam.transforms import window
-    from apache_beam.utils.windowed_value import WindowedValue
-    self._cached.append(element)
-    if len(self._cached) >= self._batch_size:
-      emit = self._cached
-      self._cached = []
-      yield emit
+def decode_batch(lines, names, dtype):
+  """Parses a batch of csv lines into a DataFrame in one call.
 
-  def finish_bundle(self, context=None):
-    from apache_beam.transforms import window
-    from apache_beam.utils.windowed_value import WindowedValue
-    if len(self._cached) > 0:
-      yield WindowedValue(self._cached, -1, [window.GlobalWindow()])
+  Columns not in dtype are kept as the text of the input, empty values
+  included, so they are written back unchanged.
+  """
+  import StringIO
+  import pandas as pd
 
+  return pd.read_csv(StringIO.StringIO('\n'.join(lines)), header=None, names=names,
+                     dtype=dtype, keep_default_na=False, na_values=[''])
 
-class TargetToLastDoFn(beam.DoFn):
-  """A DoFn that moves specified target column to last."""
 
-  def __init__(self, names, target_name):
-    self._names = names
-    self._target_name = target_name
-    self._names_no_target = list(names)
-    self._names_no_target.remove(target_name)
+def encode_batch(columns):
+  """Writes columns of the same length, Series or 1-D/2-D arrays, side by
+  side as one block of csv lines without a trailing line separator."""
+  import pandas as pd
 
-  def process(self, element):
-    import csv
-    content = csv.DictReader([element], fieldnames=self._names).next()
-    target = content.pop(self._target_name)
-    yield [content[x] for x in self._names_no_target] + [target]
+  frames = []
+  for column in columns:
+    if isinstance(column, pd.Series):
+      frames.append(column.reset_index(drop=True))
+    else:
+      frames.append(pd.DataFrame(column))
+  block = pd.concat(frames, axis=1).to_csv(header=False, index=False)
+  return block[:-1] if block.endswith('\n') else block
 
 
 class PredictDoFn(beam.DoFn):
-  """A DoFn that performs predictions with given trained model."""
+  """A DoFn that performs predictions on a batch of csv lines with given
+  trained model, and emits the results as one block of csv lines.
+
+  Each output line holds the input columns with the target moved last, then
+  the predicted label and the score of every label for classification, or
+  the outputs of the model for regression.
+  """
 
-  def __init__(self, model_export_dir):
+  def __init__(self, model_export_dir, names, target_name, labels=None):
     self._model_export_dir = model_export_dir
+    self._names = names
+    self._target_name = target_name
+    self._feature_names = [x for x in names if x != target_name]
+    self._labels = labels
+    self._model_loads = Metrics.counter(self.__class__, 'model_loads')
 
-  def start_bundle(self):
+  def _load_model(self):
     from tensorflow.contrib import predictor
+    from tensorflow.python.tools import saved_model_utils
 
     # We need to import the tensorflow_transform library in order to
     # register all of the ops that might be used by a saved model that
     # incorporates TFT transformations.
     import tensorflow_transform
 
-    self._predict_fn = predictor.from_saved_model(self._model_export_dir)
+    # Models exporting the dense tensor signature are fed the features as a
+    # float32 array instead of csv lines parsed again inside the graph.
+    meta_graph = saved_model_utils.get_meta_graph_def(self._model_export_dir, 'serve')
+    use_tensor_signature = TENSOR_SIGNATURE_KEY in meta_graph.signature_def
+    if use_tensor_signature:
+      predict_fn = predictor.from_saved_model(
+          self._model_export_dir, signature_def_key=TENSOR_SIGNATURE_KEY)
+    else:
+      predict_fn = predictor.from_saved_model(self._model_export_dir)
+    return predict_fn, use_tensor_signature
+
+  def setup(self):
+    # Called once per DoFn instance by Beam releases that support it, the
+    # model is then ready before the first bundle.
+    self.start_bundle()
 
-  def process(self, element):
-    import csv
-    import StringIO
-
-    prediction_inputs = []
-    for instance in element:
-      instance_copy = list(instance)
-      instance_copy.pop() # remove target
-      buf = StringIO.StringIO()
-      writer = csv.writer(buf, lineterminator='')
-      writer.writerow(instance_copy)
-      prediction_inputs.append(buf.getvalue())
-    
-    return_dict = self._predict_fn({"inputs": prediction_inputs})
-    return_dict['source'] = element
-    yield return_dict
-
-
-class ListToCsvDoFn(beam.DoFn):
-  """A DoFn function that convert list to csv line."""
+  def start_bundle(self):
+    # The model is loaded once per worker process and shared by all bundles
+    # and threads, the session of a predictor being safe to run concurrently.
+    import model_cache
+    self._predict_fn, self._use_tensor_signature = model_cache.get_model(
+        self._model_export_dir, self._load_model, self._model_loads.inc)
 
   def process(self, element):
-    import csv
-    import StringIO
-    buf = StringIO.StringIO()
-    writer = csv.writer(buf, lineterminator='')
-    writer.writerow(element)
-    yield buf.getvalue()
-  
+    import numpy as np
+
+    # Every column is kept as the text of the input, so that it is written
+    # back unchanged.
+    data = decode_batch(element, self._names, dict((x, str) for x in self._names))
+    if self._use_tensor_signature:
+      features = data[self._feature_names].values.astype(np.float32)
+      return_dict = self._predict_fn({"inputs": features})
+      # The tensor signature is a predict signature, whose outputs are named
+      # unlike those of the classification and regression signatures.
+      return_dict['scores'] = return_dict.get('probabilities')
+      return_dict['outputs'] = return_dict.get('predictions')
+    else:
+      # The model parses csv lines itself, they are rebuilt from the text of
+      # the features, with one writer for the whole batch.
+      inputs = encode_batch([data[x] for x in self._feature_names]).split('\n')
+      return_dict = self._predict_fn({"inputs": inputs})
+
+    columns = [data[x] for x in self._feature_names] + [data[self._target_name]]
+    if self._labels is not None:
+      scores = return_dict['scores']
+      columns.append(np.asarray(self._labels, dtype=object)[scores.argmax(axis=1)])
+      columns.append(scores)
+    else:
+      outputs = return_dict['outputs']
+      columns.append(outputs.reshape(len(outputs), -1))
+    yield encode_batch(columns)
+
 
 def run_predict(output_dir, data_path, schema, target_name, model_export_dir,
-                project, mode, batch_size):
+                project, mode, batch_size, num_workers=0):
   """Run predictions with given model using DataFlow.
   Args:
     output_dir: output folder
@@ -160,8 +194,9 @@ def run_predict(output_dir, data_path, schema, target_name, model_export_dir,
     target_name: target column name.
     model_export_dir: GCS or local path of exported model trained with tft preprocessed data.
     project: the project to run dataflow in.
-    local: whether the job should be local or cloud.
-    batch_size: batch size when running prediction.
+    mode: whether the job should be `local`, `local-parallel` or `cloud`.
+    batch_size: maximum batch size when running prediction.
+    num_workers: worker processes in `local-parallel` mode, 0 for all CPUs.
   """
 
   target_type = next(x for x in schema if x['name']==target_name)['type']
@@ -184,6 +219,22 @@ def run_predict(output_dir, data_path, schema, target_name, model_export_dir,
     output_schema.append({'name': 'target', 'type': 'NUMBER'})
     output_schema.append({'name': 'predicted', 'type': 'NUMBER'})
 
+  if is_classification:
+    predict_fn = PredictDoFn(model_export_dir, names, target_name, labels)
+  else:
+    predict_fn = PredictDoFn(model_export_dir, names, target_name)
+
+  if mode == 'local-parallel':
+    # Each process runs the whole pipeline on its shard of the lines and
+    # writes its own prediction_results file.
+    def run_shard(shard_index, num_shards):
+      run_pipeline('DirectRunner', None, data_path, predict_fn, batch_size,
+                   '%s-%05d-of-%05d' % (output_file_prefix, shard_index, num_shards),
+                   shard=(shard_index, num_shards))
+    local_parallel.run_sharded(run_shard, num_workers)
+    file_io.write_string_to_file(output_schema_file, json.dumps(output_schema))
+    return
+
   if mode == 'local':
     pipeline_options = None
     runner = 'DirectRunner'
@@ -199,31 +250,54 @@ def run_predict(output_dir, data_path, schema, target_name, model_export_dir,
   else:
     raise ValueError("Invalid mode %s." % mode)
 
-  with beam.Pipeline(runner, options=pipeline_options) as p:
-    raw_results = (p
-    | 'read data' >> beam.io.ReadFromText(data_path)
-    | 'move target to last' >> beam.ParDo(TargetToLastDoFn(names, target_name))
-    | 'batch' >> beam.ParDo(EmitAsBatchDoFn(batch_size))
-    | 'predict' >> beam.ParDo(PredictDoFn(model_export_dir)))
-
-    if is_classification:
-      processed_results = (raw_results
-        | 'unbatch' >> beam.FlatMap(lambda x: zip(x['source'], x['scores']))
-        | 'get predicted' >> beam.Map(lambda x: x[0] + [labels[x[1].argmax()]] + list(x[1])))
-    else:
-      processed_results = (raw_results
-        | 'unbatch' >> beam.FlatMap(lambda x: zip(x['source'], x['outputs']))
-        | 'get predicted' >> beam.Map(lambda x: x[0] + list(x[1])))
+  run_pipeline(runner, pipeline_options, data_path, predict_fn, batch_size, output_file_prefix,
+               output_schema=output_schema, output_schema_file=output_schema_file)
 
-    results_save = (processed_results
-      | 'write csv lines' >> beam.ParDo(ListToCsvDoFn())
-      | 'write file' >> beam.io.WriteToText(output_file_prefix))
 
+def run_pipeline(runner, pipeline_options, data_path, predict_fn, batch_size, output_file_prefix,
+                 output_schema=None, output_schema_file=None, shard=None):
+  """Run the prediction pipeline and wait for it to finish.
+  Args:
+    runner: Beam runner name.
+    pipeline_options: PipelineOptions of the runner, or None.
+    data_path: test data file path.
+    predict_fn: PredictDoFn turning batches of lines into prediction lines.
+    batch_size: maximum batch size when running prediction.
+    output_file_prefix: prefix of the prediction files.
+    output_schema: schema list of the prediction files, written to
+      output_schema_file when given.
+    output_schema_file: path of the schema file.
+    shard: (shard_index, num_shards) to predict only the lines of one shard,
+      written to a single file named output_file_prefix, or None for all lines.
+  """
+
+  p = beam.Pipeline(runner, options=pipeline_options)
+  lines = p | 'read data' >> beam.io.ReadFromText(data_path)
+  if shard is None:
+    write = beam.io.WriteToText(output_file_prefix)
+  else:
+    lines = lines | 'shard' >> beam.Filter(local_parallel.in_shard, *shard)
+    write = beam.io.WriteToText(output_file_prefix, shard_name_template='')
+  # Batches grow adaptively up to batch_size, following the measured
+  # throughput of the prediction, and each is written as one block of lines.
+  results_save = (lines
+    | 'batch' >> beam.BatchElements(min_batch_size=1, max_batch_size=batch_size)
+    | 'predict' >> beam.ParDo(predict_fn)
+    | 'write file' >> write)
+
+  if output_schema_file:
     (results_save
       | 'fixed one' >> beam.transforms.combiners.Sample.FixedSizeGlobally(1)
       | 'set schema' >> beam.Map(lambda path: json.dumps(output_schema))
       | 'write schema file' >> beam.io.WriteToText(output_schema_file, shard_name_template=''))
 
+  result = p.run()
+  result.wait_until_finish()
+  # One load per worker process is expected, more means the model was not
+  # shared.
+  model_loads = result.metrics().query(MetricsFilter().with_name('model_loads'))['counters']
+  logging.info('Model loads: %d', sum(x.committed or 0 for x in model_loads))
+
 
 def main():
   logging.getLogger().setLevel(logging.INFO)
@@ -235,7 +309,7 @@ def main():
   schema = json.loads(file_io.read_file_to_string(args.schema))
 
   run_predict(args.output, args.data, schema, args.target, model_export_dir,
-              args.project, args.mode, args.batchsize)
+              args.project, args.mode, args.batchsize, args.num_workers)
   prediction_results = os.path.join(args.output, 'prediction_results-*')
   with open('/output.txt', 'w') as f:
     f.write(prediction_results)
@@ -20,6 +20,7 @@ setup(
   name='trainer',
   version='1.0.0',
   packages=find_packages(),
+  py_modules=['model_cache'],
   description='DNN Trainer',
   author='Google',
   keywords=[
@@ -15,15 +15,26 @@
 
 import apache_beam as beam
 import argparse
+import csv
 import datetime
+import hashlib
 import json
 import logging
 import os
 import tensorflow_data_validation as tfdv
+import zlib
 
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
 from apache_beam.options.pipeline_options import StandardOptions
 from tensorflow.python.lib.io import file_io
 from tensorflow_metadata.proto.v0 import schema_pb2
+from tensorflow_metadata.proto.v0 import statistics_pb2
+
+SAMPLING_FILE = 'sampling.json'
+# Fingerprint of the inference data the statistics and schema in the output
+# dir were computed from.
+STATS_FINGERPRINT_FILE = 'data_stats.json'
 
 
 def parse_arguments():
@@ -61,6 +72,25 @@ def parse_arguments():
         '--mode',
         choices=['local', 'cloud'],
         help='Whether to run the job locally or in Cloud Dataflow.')
+    parser.add_argument(
+        '--sample-rate',
+        type=float,
+        default=1.0,
+        help='Fraction of the rows the statistics are computed on. 1 uses '
+             'every row.')
+    parser.add_argument(
+        '--sample-count',
+        type=int,
+        default=0,
+        help='Number of rows drawn uniformly at random to compute the '
+             'statistics on, or per value of --stratify-column. 0 keeps '
+             'every row.')
+    parser.add_argument(
+        '--stratify-column',
+        type=str,
+        default='',
+        help='Column whose every value gets --sample-count rows, so that rare '
+             'values are kept in the sample.')
 
     args = parser.parse_args()
     return args
@@ -100,8 +130,167 @@ def convert_schema_proto_to_json(schema, column_names, key_columns):
     return schema_json
 
 
+class _CountRows(beam.DoFn):
+    """Counts the elements going through in a Beam counter."""
+
+    def __init__(self, name):
+        self._counter = Metrics.counter(self.__class__, name)
+
+    def process(self, element):
+        self._counter.inc()
+        yield element
+
+
+def _line_hash(line):
+    if not isinstance(line, bytes):
+        line = line.encode('utf-8')
+    return zlib.crc32(line) & 0xffffffff
+
+
+class SampleRows(beam.PTransform):
+    """Samples the lines of a CSV file.
+
+    Lines are kept with probability rate, by a hash of their content so the
+    sample is the same on every run. Then count lines are drawn uniformly at
+    random from them, or count lines per value of the column at
+    stratify_index.
+    """
+
+    def __init__(self, rate=1.0, count=0, stratify_index=None):
+        super(SampleRows, self).__init__()
+        self._rate = rate
+        self._count = count
+        self._stratify_index = stratify_index
+
+    def expand(self, lines):
+        if self._rate < 1:
+            threshold = self._rate * 2 ** 32
+            lines = lines | 'SampleRate' >> beam.Filter(
+                lambda line: _line_hash(line) < threshold)
+        if not self._count:
+            return lines
+        if self._stratify_index is None:
+            return (lines
+                    | 'SampleCount' >> beam.combiners.Sample.FixedSizeGlobally(self._count)
+                    | 'FlattenSample' >> beam.FlatMap(lambda sample: sample))
+        stratify_index = self._stratify_index
+        return (lines
+                | 'KeyByStratum' >> beam.Map(
+                    lambda line: (next(csv.reader([line]))[stratify_index], line))
+                | 'SampleCountPerStratum' >> beam.combiners.Sample.FixedSizePerKey(self._count)
+                | 'FlattenSample' >> beam.FlatMap(lambda stratum: stratum[1]))
+
+
+def read_csv_header(data_location):
+    """Returns the column names in the first line of the first file."""
+    first_file = file_io.get_matching_files(data_location)[0]
+    with file_io.FileIO(first_file, 'r') as f:
+        return next(csv.reader([f.readline().strip()]))
+
+
+def generate_statistics(data_location, column_names, output_path,
+                        pipeline_options, sampling):
+    """Generates the statistics of a sample of a CSV file, as
+    tfdv.generate_statistics_from_csv does for all its rows.
+
+    Args:
+      data_location: file pattern of the CSV file.
+      column_names: list of names for the columns, None to read them from the
+          first line.
+      output_path: path of the statistics TFRecord file.
+      pipeline_options: the Beam pipeline options.
+      sampling: dict of SampleRows arguments, with the column name of the
+          strata as 'stratify_column'.
+    Returns:
+      The statistics and a dict recording the sampling rate.
+    """
+    skip_header_lines = 0
+    if column_names is None:
+        column_names = read_csv_header(data_location)
+        skip_header_lines = 1
+    stratify_index = None
+    if sampling['stratify_column']:
+        stratify_index = column_names.index(sampling['stratify_column'])
+
+    p = beam.Pipeline(options=pipeline_options)
+    _ = (p
+         | 'ReadData' >> beam.io.ReadFromText(
+             data_location, skip_header_lines=skip_header_lines)
+         | 'CountRows' >> beam.ParDo(_CountRows('rows'))
+         | 'Sample' >> SampleRows(sampling['rate'], sampling['count'],
+                                  stratify_index)
+         | 'CountSampledRows' >> beam.ParDo(_CountRows('sampled_rows'))
+         | 'DecodeData' >> tfdv.DecodeCSV(column_names=column_names,
+                                          delimiter=',')
+         | 'GenerateStatistics' >> tfdv.GenerateStatistics()
+         | 'WriteStatsOutput' >> beam.io.WriteToTFRecord(
+             output_path, shard_name_template='',
+             coder=beam.coders.ProtoCoder(
+                 statistics_pb2.DatasetFeatureStatisticsList)))
+    result = p.run()
+    result.wait_until_finish()
+
+    counts = {}
+    for name in ('rows', 'sampled_rows'):
+        counters = result.metrics().query(
+            MetricsFilter().with_name(name))['counters']
+        counts[name] = sum(x.committed or 0 for x in counters)
+    record = dict(sampling, **counts)
+    record['sampling_rate'] = (
+        float(counts['sampled_rows']) / counts['rows'] if counts['rows'] else 1.0)
+    logging.getLogger().info('Statistics of {} computed on {} of {} rows.'.format(
+        data_location, counts['sampled_rows'], counts['rows']))
+    return tfdv.load_statistics(output_path), record
+
+
+def compute_fingerprint(data_location, column_names, sampling):
+    """Returns a sha256 hex digest of what the statistics of a CSV file
+    depend on: the name, size and modification time of each of its files,
+    the column names, the sampling options and the source of this step.
+    File contents are not read, so the fingerprint costs a listing instead
+    of a pass over the data."""
+    data_files = []
+    for data_file in sorted(file_io.get_matching_files(data_location)):
+        stat = file_io.stat(data_file)
+        data_files.append([data_file, stat.length, stat.mtime_nsec])
+    fingerprint = hashlib.sha256(json.dumps({
+        'files': data_files,
+        'column_names': column_names,
+        'sampling': sampling,
+    }, sort_keys=True).encode('utf-8'))
+    with open(os.path.abspath(__file__), 'rb') as f:
+        fingerprint.update(f.read())
+    return fingerprint.hexdigest()
+
+
+def load_cached_statistics(output_dir, fingerprint):
+    """Returns the schema and sampling record of the statistics previously
+    computed in output_dir from inference data with this fingerprint, or
+    None."""
+    marker_file = os.path.join(output_dir, STATS_FINGERPRINT_FILE)
+    stats_file = os.path.join(output_dir, 'data_stats.tfrecord')
+    schema_file = os.path.join(output_dir, 'schema.pb2')
+    if not all(file_io.file_exists(x) for x in (marker_file, stats_file, schema_file)):
+        return None
+    marker = json.loads(file_io.read_file_to_string(marker_file))
+    if marker['fingerprint'] != fingerprint:
+        return None
+    schema = schema_pb2.Schema()
+    schema.ParseFromString(file_io.read_file_to_string(schema_file, binary_mode=True))
+    return schema, marker['sampling']
+
+
+def record_statistics(output_dir, fingerprint, sampling_record):
+    """Records the fingerprint of the inference data the statistics and
+    schema in output_dir were computed from."""
+    file_io.write_string_to_file(
+        os.path.join(output_dir, STATS_FINGERPRINT_FILE),
+        json.dumps({'fingerprint': fingerprint, 'sampling': sampling_record,
+                    'created': datetime.datetime.now().isoformat()}))
+
+
 def run_validator(output_dir, column_names, key_columns, csv_data_file,
-                  csv_data_file_to_validate, project, mode):
+                  csv_data_file_to_validate, project, mode, sampling=None):
     """Writes a TFDV-generated schema.
 
     Args:
@@ -115,6 +304,8 @@ def run_validator(output_dir, column_names, key_columns, csv_data_file,
           against the schema.
       project: the project to run dataflow in.
       mode: whether the job should be `local` or `cloud`.
+      sampling: dict with the 'rate', 'count' and 'stratify_column' the rows
+          of both CSV files are sampled with, None to use every row.
     """
     if mode == 'local':
         pipeline_options = None
@@ -133,18 +324,40 @@ def run_validator(output_dir, column_names, key_columns, csv_data_file,
     else:
         raise ValueError("Invalid mode %s." % mode)
 
-    stats = tfdv.generate_statistics_from_csv(
-        data_location=csv_data_file,
-        column_names=column_names,
-        delimiter=',',
-        output_path=os.path.join(output_dir, 'data_stats.tfrecord'),
-        pipeline_options=pipeline_options)
-    schema = tfdv.infer_schema(stats)
+    # The statistics and schema of unchanged inference data are reused, so
+    # only the data to validate is read.
+    sampling_records = {}
+    fingerprint = compute_fingerprint(csv_data_file, column_names, sampling)
+    cached = load_cached_statistics(output_dir, fingerprint)
+    if cached:
+        logging.getLogger().info(
+            'Reusing the statistics and schema of {} in {}'.format(
+                csv_data_file, output_dir))
+        schema, sampling_record = cached
+        if sampling_record:
+            sampling_records['inference'] = sampling_record
+    else:
+        if sampling:
+            stats, sampling_records['inference'] = generate_statistics(
+                csv_data_file, column_names,
+                os.path.join(output_dir, 'data_stats.tfrecord'),
+                pipeline_options, sampling)
+        else:
+            stats = tfdv.generate_statistics_from_csv(
+                data_location=csv_data_file,
+                column_names=column_names,
+                delimiter=',',
+                output_path=os.path.join(output_dir, 'data_stats.tfrecord'),
+                pipeline_options=pipeline_options)
+        schema = tfdv.infer_schema(stats)
     with open('/output_schema.pb2', 'w+') as f:
         f.write(schema.SerializeToString())
-    with file_io.FileIO(os.path.join(output_dir, 'schema.pb2'), 'w+') as f:
-        logging.getLogger().info('Writing schema to {}'.format(f.name))
-        f.write(schema.SerializeToString())
+    if not cached:
+        with file_io.FileIO(os.path.join(output_dir, 'schema.pb2'), 'w+') as f:
+            logging.getLogger().info('Writing schema to {}'.format(f.name))
+            f.write(schema.SerializeToString())
+        record_statistics(output_dir, fingerprint,
+                          sampling_records.get('inference'))
     schema_json = convert_schema_proto_to_json(
         schema, column_names, key_columns)
     with open('/output_schema.json', 'w+') as f:
@@ -156,15 +369,31 @@ def run_validator(output_dir, column_names, key_columns, csv_data_file,
     with open('/schema.txt', 'w+') as f:
         f.write(schema_json_file)
 
+    if csv_data_file_to_validate:
+        if sampling:
+            validation_stats, sampling_records['validation'] = (
+                generate_statistics(
+                    csv_data_file_to_validate, column_names,
+                    os.path.join(output_dir, 'validation_data_stats.tfrecord'),
+                    pipeline_options, sampling))
+        else:
+            validation_stats = tfdv.generate_statistics_from_csv(
+                data_location=csv_data_file_to_validate,
+                column_names=column_names,
+                delimiter=',',
+                output_path=os.path.join(output_dir,
+                                         'validation_data_stats.tfrecord'),
+                pipeline_options=pipeline_options)
+
+    if sampling_records:
+        sampling_file = os.path.join(output_dir, SAMPLING_FILE)
+        with file_io.FileIO(sampling_file, 'w+') as f:
+            logging.getLogger().info('Writing sampling rates to {}'.format(f.name))
+            json.dump(sampling_records, f)
+
     if not csv_data_file_to_validate:
         return
 
-    validation_stats = tfdv.generate_statistics_from_csv(
-        data_location=csv_data_file_to_validate,
-        column_names=column_names,
-        delimiter=',',
-        output_path=os.path.join(output_dir, 'validation_data_stats.tfrecord'),
-        pipeline_options=pipeline_options)
     anomalies = tfdv.validate_statistics(validation_stats, schema)
     with open('/output_validation_result.txt', 'w+') as f:
         if len(anomalies.anomaly_info.items()) > 0:
@@ -190,11 +419,24 @@ def main():
         column_names = json.loads(
             file_io.read_file_to_string(args.column_names))
 
+    sampling = None
+    if args.sample_rate < 1 or args.sample_count or args.stratify_column:
+        if not 0 < args.sample_rate <= 1:
+            raise ValueError('--sample-rate must be in (0, 1], got {}.'.format(
+                args.sample_rate))
+        if args.stratify_column and not args.sample_count:
+            raise ValueError('--stratify-column needs --sample-count.')
+        sampling = {
+            'rate': args.sample_rate,
+            'count': args.sample_count,
+            'stratify_column': args.stratify_column,
+        }
+
     run_validator(args.output, column_names,
                   args.key_columns.split(','),
                   args.csv_data_for_inference,
                   args.csv_data_to_validate,
-                  args.project, args.mode)
+                  args.project, args.mode, sampling)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Compares the time to load the Santander data from CSV and from the columnar
+# copy written by the transform step, and from Parquet when pyarrow is
+# installed.
+# Usage:
+# python benchmark_load.py \
+#   --data=gs://kubeflow-pipelines-demo/dataset/train.csv \
+#   --repeats=3
+
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from tensorflow.python.lib.io import file_io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'base', 'src'))
+import transform
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data',
+                        type=str,
+                        required=True,
+                        help='GCS or local path of a Santander CSV file.')
+    parser.add_argument('--repeats',
+                        type=int,
+                        default=3,
+                        help='Number of times each format is loaded, the best time is reported.')
+    return parser.parse_args()
+
+
+def timed(name, repeats, fn):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    print('%-28s %10.3f s' % (name, min(times)))
+
+
+def load_columnar(data_dir, mmap_mode):
+    features = np.load(os.path.join(data_dir, 'features.npy'), mmap_mode=mmap_mode)
+    target = np.load(os.path.join(data_dir, 'target.npy'), mmap_mode=mmap_mode)
+    # Touch every value, so a memory-mapped load is not measured as free.
+    return features.sum(), target.sum()
+
+
+def main():
+    args = parse_arguments()
+    work_dir = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(work_dir, 'data.csv')
+        file_io.copy(args.data, csv_path)
+        data = transform.read_csv_files(csv_path)
+        columnar_dir = os.path.join(work_dir, 'columnar')
+        transform.write_columnar(data, columnar_dir)
+        print('%d rows, %d columns' % data.shape)
+
+        timed('csv (pandas defaults)', args.repeats, lambda: pd.read_csv(csv_path))
+        timed('csv (float32 dtypes)', args.repeats, lambda: transform.read_csv_files(csv_path))
+        timed('npy', args.repeats, lambda: load_columnar(columnar_dir, None))
+        timed('npy (memory-mapped)', args.repeats, lambda: load_columnar(columnar_dir, 'r'))
+        if pq is not None:
+            parquet_path = os.path.join(work_dir, 'data.parquet')
+            data.to_parquet(parquet_path)
+            timed('parquet', args.repeats, lambda: pq.read_table(parquet_path).to_pandas())
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,11 +17,28 @@ import apache_beam as beam
 import argparse
 import datetime
 import csv
+import hashlib
 import json
 import logging
 import os
+import sys
+import numpy as np
 import pandas as pd
+import tensorflow as tf
+import tensorflow_transform as tft
+
+from apache_beam.io import textio
+from apache_beam.io import tfrecordio
+from apache_beam.io.filesystem import CompressionTypes
+from apache_beam.options.pipeline_options import StandardOptions
 from tensorflow.python.lib.io import file_io
+from tensorflow_transform.beam import impl as beam_impl
+from tensorflow_transform.beam.tft_beam_io import transform_fn_io
+from tensorflow_transform.coders import csv_coder
+from tensorflow_transform.coders import example_proto_coder
+from tensorflow_transform.tf_metadata import dataset_metadata
+from tensorflow_transform.tf_metadata import dataset_schema
+from tensorflow_transform.tf_metadata import metadata_io
 
 # Inception Checkpoint
 INCEPTION_V3_CHECKPOINT = 'gs://cloud-ml-data/img/flower_photos/inception_v3_2016_08_28.ckpt'
@@ -30,6 +47,27 @@ INCEPTION_EXCLUDED_VARIABLES = ['InceptionV3/AuxLogits', 'InceptionV3/Logits', '
 DELIMITERS = '.,!?() '
 VOCAB_SIZE = 100000
 
+# Columns of the Santander data that are not features.
+ID_COLUMN = 'ID_code'
+TARGET_COLUMN = 'target'
+
+# Typed columnar copy of the train and eval data, written to
+# <output>/columnar/{train,eval}/ as memory-mappable .npy arrays, so later
+# steps load it instead of parsing the CSV again:
+#   features.npy  float32 [N, num_features]
+#   target.npy    int8 [N], when the data has a target column
+#   ids.npy       fixed-width bytes [N], the ID of every row
+#   columns.json  {"id": ..., "target": ..., "features": [...]}
+COLUMNAR_DIR = 'columnar'
+COLUMNAR_COLUMNS_FILE = 'columns.json'
+
+# Bytes read at a time when fingerprinting the input files.
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+# Rows read to infer the schema of the data when --schema is not a valid
+# json schema file.
+SCHEMA_INFERENCE_ROWS = 1000
+
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -58,45 +96,332 @@ def parse_arguments():
     parser.add_argument('--mode',
                         choices=['local', 'cloud'],
                         help='whether to run the job locally or in Cloud Dataflow.')
+    parser.add_argument('--scale-numeric',
+                        type=str,
+                        default='false',
+                        help='"true" scales NUMBER columns to z-scores, for models served through '
+                             'the transform graph. Trees are trained on raw values by default.')
     parser.add_argument('--preprocessing-module',
                         type=str,
                         required=False,
                         help=('GCS path to a python file defining '
                               '"preprocess" and "get_feature_columns" functions.'))
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default='',
+                        help='GCS or local directory recording the output of previous runs by '
+                             'fingerprint of their inputs. A run with the same input files, '
+                             'schema, preprocessing module and transform code reuses that '
+                             'output instead of transforming the data again.')
 
     args = parser.parse_args()
+    args.scale_numeric = args.scale_numeric.lower() == 'true'
     return args
 
 
-def run_transform(output_dir, train_data_file, eval_data_file):
+def infer_schema(file_pattern):
+    """Infers a json schema from the header and leading rows of the first file
+    matching a pattern. Numeric columns are NUMBER, the ID column is a KEY and
+    the target and other text columns are CATEGORY."""
+    data_file = sorted(file_io.get_matching_files(file_pattern))[0]
+    with file_io.FileIO(data_file, 'r') as f:
+        sample = pd.read_csv(f, nrows=SCHEMA_INFERENCE_ROWS)
+    schema = []
+    for name, dtype in zip(sample.columns, sample.dtypes):
+        if name == ID_COLUMN:
+            col_type = 'KEY'
+        elif name == TARGET_COLUMN or not np.issubdtype(dtype, np.number):
+            col_type = 'CATEGORY'
+        else:
+            col_type = 'NUMBER'
+        schema.append({'name': name, 'type': col_type})
+    return schema
+
+
+def load_schema(schema_file, file_pattern):
+    """Loads the json schema file, or infers the schema from the data when the
+    file cannot be read or is not a json schema."""
+    try:
+        schema = json.loads(file_io.read_file_to_string(schema_file))
+        if isinstance(schema, list) and all('name' in x and 'type' in x for x in schema):
+            return schema
+    except (tf.errors.OpError, ValueError):
+        pass
+    logging.info('No valid schema in %s, inferring it from %s', schema_file, file_pattern)
+    return infer_schema(file_pattern)
+
+
+def make_tft_input_metadata(schema):
+    """Create tf-transform metadata from given schema."""
+    tft_schema = {}
+
+    for col_schema in schema:
+        col_type = col_schema['type']
+        col_name = col_schema['name']
+        if col_type == 'NUMBER':
+            tft_schema[col_name] = dataset_schema.ColumnSchema(
+                tf.float32, [], dataset_schema.FixedColumnRepresentation(default_value=0.0))
+        elif col_type in ['CATEGORY', 'TEXT', 'IMAGE_URL', 'KEY']:
+            tft_schema[col_name] = dataset_schema.ColumnSchema(
+                tf.string, [], dataset_schema.FixedColumnRepresentation(default_value=''))
+    return dataset_metadata.DatasetMetadata(dataset_schema.Schema(tft_schema))
+
+
+def make_preprocessing_fn(schema, scale_numeric):
+    """Makes a preprocessing_fn for the schema: CATEGORY and TEXT columns are
+    mapped to ids of a vocabulary, NUMBER columns are scaled to z-scores when
+    scale_numeric is set, KEY columns are passed through.
+    The target keeps its integer class, as a frequency ordered vocabulary
+    would give class 1 the id 0 whenever it is the most frequent. Its
+    vocabulary is still written as vocab_<target> for the trainer to count
+    the classes."""
+
+    def preprocessing_fn(inputs):
+        result = {}
+        for col_schema in schema:
+            col_name = col_schema['name']
+            col_type = col_schema['type']
+            if col_name == TARGET_COLUMN and col_type in ['CATEGORY', 'NUMBER']:
+                target = inputs[col_name]
+                if col_type == 'NUMBER':
+                    target = tf.as_string(tf.to_int64(target))
+                tft.uniques(target, vocab_filename='vocab_' + col_name)
+                result[col_name] = tf.string_to_number(target, out_type=tf.int64)
+            elif col_type == 'NUMBER':
+                result[col_name] = (tft.scale_to_z_score(inputs[col_name]) if scale_numeric
+                                    else inputs[col_name])
+            elif col_type in ['CATEGORY', 'TEXT', 'IMAGE_URL']:
+                result[col_name] = tft.string_to_int(inputs[col_name],
+                                                     vocab_filename='vocab_' + col_name)
+            elif col_type == 'KEY':
+                result[col_name] = inputs[col_name]
+        return result
+
+    return preprocessing_fn
+
+
+def load_preprocessing_fn(preprocessing_module):
+    """Loads the "preprocess" function of a python file as the preprocessing_fn.
+    Boolean outputs are mapped to ids of a vocabulary."""
+    module_dir = os.path.abspath(os.path.dirname(__file__))
+    with open(os.path.join(module_dir, 'preprocessing.py'), 'w+') as f:
+        f.write(file_io.read_file_to_string(preprocessing_module))
+    sys.path.insert(0, module_dir)
+    import preprocessing
+
+    def preprocessing_fn(inputs):
+        outputs = preprocessing.preprocess(inputs)
+        for key in outputs:
+            if outputs[key].dtype == tf.bool:
+                outputs[key] = tft.string_to_int(tf.as_string(outputs[key]),
+                                                 vocab_filename='vocab_' + key)
+        return outputs
+
+    return preprocessing_fn
+
+
+def read_csv_files(file_pattern):
+    """Reads the CSV files matching a pattern into one DataFrame, parsing the
+    features as float32 and the target as int8."""
+    frames = []
+    for data_file in sorted(file_io.get_matching_files(file_pattern)):
+        with file_io.FileIO(data_file, 'r') as f:
+            header = list(pd.read_csv(f, nrows=0).columns)
+        dtype = dict((x, np.float32) for x in header if x not in (ID_COLUMN, TARGET_COLUMN))
+        dtype[ID_COLUMN] = str
+        dtype[TARGET_COLUMN] = np.int8
+        with file_io.FileIO(data_file, 'r') as f:
+            frames.append(pd.read_csv(f, dtype=dtype))
+    if not frames:
+        raise ValueError('No files match "%s".' % file_pattern)
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def _save_array(path, array):
+    with file_io.FileIO(path, 'wb') as f:
+        np.save(f, array)
+
+
+def write_columnar(data, output_dir):
+    """Writes a DataFrame read by read_csv_files as .npy arrays and a columns.json
+    file describing them, see COLUMNAR_DIR."""
+    file_io.recursive_create_dir(output_dir)
+    feature_columns = [x for x in data.columns if x not in (ID_COLUMN, TARGET_COLUMN)]
+    columns = {'id': None, 'target': None, 'features': feature_columns}
+
+    _save_array(os.path.join(output_dir, 'features.npy'),
+                np.ascontiguousarray(data[feature_columns].values, dtype=np.float32))
+    if TARGET_COLUMN in data.columns:
+        _save_array(os.path.join(output_dir, 'target.npy'), data[TARGET_COLUMN].values.astype(np.int8))
+        columns['target'] = TARGET_COLUMN
+    if ID_COLUMN in data.columns:
+        _save_array(os.path.join(output_dir, 'ids.npy'), data[ID_COLUMN].values.astype(np.bytes_))
+        columns['id'] = ID_COLUMN
+    file_io.write_string_to_file(os.path.join(output_dir, COLUMNAR_COLUMNS_FILE), json.dumps(columns))
+
+
+def compute_fingerprint(file_patterns, schema, preprocessing_module, scale_numeric):
+    """Returns a sha256 hex digest of everything the transform output depends
+    on: the content of the input files, the schema, the preprocessing module,
+    the options and the source of this step."""
+    fingerprint = hashlib.sha256()
+
+    def update(name, value):
+        fingerprint.update(('%s:%d:' % (name, len(value))).encode('utf-8'))
+        fingerprint.update(value)
+
+    for file_pattern in file_patterns:
+        data_files = sorted(file_io.get_matching_files(file_pattern))
+        update('pattern', json.dumps([file_pattern, len(data_files)]).encode('utf-8'))
+        for data_file in data_files:
+            file_hash = hashlib.sha256()
+            with file_io.FileIO(data_file, 'rb') as f:
+                while True:
+                    block = f.read(FINGERPRINT_BLOCK_SIZE)
+                    if not block:
+                        break
+                    file_hash.update(block)
+            update('file', file_hash.digest())
+    update('schema', json.dumps(schema, sort_keys=True).encode('utf-8'))
+    module = file_io.read_file_to_string(preprocessing_module) if preprocessing_module else ''
+    update('module', module.encode('utf-8') if not isinstance(module, bytes) else module)
+    update('options', json.dumps({'scale_numeric': scale_numeric}).encode('utf-8'))
+    with open(os.path.abspath(__file__), 'rb') as f:
+        update('source', f.read())
+    return fingerprint.hexdigest()
+
+
+def lookup_cache(cache_dir, fingerprint):
+    """Returns the output dir of a previous run with the same fingerprint, or
+    None if there is none or its output is gone."""
+    marker = os.path.join(cache_dir, fingerprint + '.json')
+    if not file_io.file_exists(marker):
+        return None
+    output_dir = json.loads(file_io.read_file_to_string(marker))['output']
+    if not file_io.file_exists(os.path.join(output_dir, transform_fn_io.TRANSFORM_FN_DIR)):
+        logging.info('Cached output %s of fingerprint %s is gone', output_dir, fingerprint)
+        return None
+    return output_dir
+
+
+def record_cache(cache_dir, fingerprint, output_dir):
+    """Records output_dir as the output of the inputs with this fingerprint."""
+    file_io.recursive_create_dir(cache_dir)
+    file_io.write_string_to_file(
+        os.path.join(cache_dir, fingerprint + '.json'),
+        json.dumps({'output': output_dir, 'created': datetime.datetime.now().isoformat()}))
+
+
+def write_columnar_copy(output_dir, train_data_file, eval_data_file):
+    """Writes a typed columnar copy of the train and eval data.
+    Args:
+      output_dir: output folder
+      train_data_file: training data file pattern.
+      eval_data_file: eval data file pattern.
+    """
+
+    for name, file_pattern in [('train', train_data_file), ('eval', eval_data_file)]:
+        data = read_csv_files(file_pattern)
+        logging.info('Read %d %s rows from %s', len(data), name, file_pattern)
+        write_columnar(data, os.path.join(output_dir, COLUMNAR_DIR, name))
+
+
+def run_transform(output_dir, schema, train_data_file, eval_data_file,
+                  project, mode, preprocessing_fn):
     """Writes a tft transform fn, and metadata files.
+    The train data is analyzed and transformed, the eval data transformed with
+    the same transform fn, and both written as GZIP TFRecord shards
+    train-*.gz and eval-*.gz of tf.Examples.
     Args:
       output_dir: output folder
       schema: schema list.
       train_data_file: training data file pattern.
       eval_data_file: eval data file pattern.
       project: the project to run dataflow in.
-      local: whether the job should be local or cloud.
-      preprocessing_fn: a function used to preprocess the raw data. If not
-                        specified, a function will be automatically inferred
-                        from the schema.
+      mode: whether the job should be `local` or `cloud`.
+      preprocessing_fn: a function used to preprocess the raw data.
     """
+    if mode == 'local':
+        pipeline_options = None
+    elif mode == 'cloud':
+        options = {
+            'job_name': (
+                'pipeline-tft-' +
+                datetime.datetime.now().strftime('%y%m%d-%H%M%S')),
+            'project': project,
+            'temp_location': os.path.join(output_dir, 'tmp'),
+        }
+        pipeline_options = beam.pipeline.PipelineOptions(flags=[], **options)
+        pipeline_options.view_as(StandardOptions).runner = 'DataFlowRunner'
+    else:
+        raise ValueError("Invalid mode %s." % mode)
+
+    raw_metadata = make_tft_input_metadata(schema)
+    column_names = [x['name'] for x in schema]
+
+    with beam.Pipeline(options=pipeline_options) as p:
+        with beam_impl.Context(temp_dir=os.path.join(output_dir, 'tmp')):
+            converter = csv_coder.CsvCoder(column_names, raw_metadata.schema)
 
-    data = pd.read_csv(train_data_file)
+            train_data = (
+                p
+                | 'ReadTrainData' >> textio.ReadFromText(train_data_file, skip_header_lines=1)
+                | 'DecodeTrainData' >> beam.Map(converter.decode))
+            (transformed_train_data, transformed_metadata), transform_fn = (
+                (train_data, raw_metadata)
+                | 'AnalyzeAndTransform' >> beam_impl.AnalyzeAndTransformDataset(preprocessing_fn))
 
-    output_file_prefix = os.path.join(output_dir, 'preprocess_data.csv')
+            eval_data = (
+                p
+                | 'ReadEvalData' >> textio.ReadFromText(eval_data_file, skip_header_lines=1)
+                | 'DecodeEvalData' >> beam.Map(converter.decode))
+            transformed_eval_data, _ = (
+                ((eval_data, raw_metadata), transform_fn)
+                | 'TransformEval' >> beam_impl.TransformDataset())
 
-    print(data.head(10))
+            example_coder = example_proto_coder.ExampleProtoCoder(transformed_metadata.schema)
+            for name, data in [('Train', transformed_train_data), ('Eval', transformed_eval_data)]:
+                _ = (data
+                     | 'Write%sData' % name >> tfrecordio.WriteToTFRecord(
+                         os.path.join(output_dir, name.lower()),
+                         coder=example_coder,
+                         file_name_suffix='.gz',
+                         compression_type=CompressionTypes.GZIP))
 
-    # with file_io.FileIO(output_file_prefix, 'w') as f:
-    #     data.to_csv(f, columns=list(data.columns.values), header=False, index=False)
+            _ = (transform_fn
+                 | 'WriteTransformFn' >> transform_fn_io.WriteTransformFn(output_dir))
+
+    metadata_io.write_metadata(raw_metadata, os.path.join(output_dir, 'metadata'))
+    file_io.write_string_to_file(os.path.join(output_dir, 'schema.json'), json.dumps(schema))
 
 
 def main():
     logging.getLogger().setLevel(logging.INFO)
     args = parse_arguments()
+    schema = load_schema(args.schema, args.train)
+
+    fingerprint = None
+    if args.cache_dir:
+        fingerprint = compute_fingerprint([args.train, args.eval], schema,
+                                          args.preprocessing_module, args.scale_numeric)
+        cached_output = lookup_cache(args.cache_dir, fingerprint)
+        if cached_output:
+            logging.info('Inputs with fingerprint %s were transformed to %s, reusing it',
+                         fingerprint, cached_output)
+            with open('/output.txt', 'w') as f:
+                f.write(cached_output)
+            return
+
+    if args.preprocessing_module:
+        preprocessing_fn = load_preprocessing_fn(args.preprocessing_module)
+    else:
+        preprocessing_fn = make_preprocessing_fn(schema, args.scale_numeric)
 
-    run_transform(args.output, args.train, args.eval)
+    run_transform(args.output, schema, args.train, args.eval, args.project, args.mode,
+                  preprocessing_fn)
+    write_columnar_copy(args.output, args.train, args.eval)
+    if fingerprint:
+        record_cache(args.cache_dir, fingerprint, args.output)
 
     with open('/output.txt', 'w') as f:
         f.write(args.output)
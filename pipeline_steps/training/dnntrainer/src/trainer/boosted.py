@@ -10,9 +10,32 @@ import numpy as np
 import tensorflow as tf
 import pandas as pd
 
+import gzip
+import io
 import json
 import os
 import argparse
+from multiprocessing.pool import ThreadPool
+
+from tensorflow.python.lib.io import file_io
+
+from trainer import quantiles
+
+# Name of the alternative serving input that takes a dense float32 tensor.
+# Its prediction signature is exported as "tensor:predict".
+TENSOR_RECEIVER_NAME = 'tensor'
+
+# Columns of the Santander data that are not features.
+ID_COLUMN = 'ID_code'
+TARGET_COLUMN = 'target'
+
+# Bucket boundaries saved in the transformed data dir by the streaming mode.
+BUCKET_BOUNDARIES_FILE = 'bucket_boundaries.json'
+
+# Typed columnar copy of the training data written by the transform step to
+# <transformed-data-dir>/columnar/train/, see preprocessing/tft/src/transform.py.
+COLUMNAR_TRAIN_DIR = os.path.join('columnar', 'train')
+COLUMNAR_COLUMNS_FILE = 'columns.json'
 
 
 def parse_arguments():
@@ -68,6 +91,43 @@ def parse_arguments():
                         default=200,
                         help='Number of eval examples within the data.')
 
+    parser.add_argument('--input-mode',
+                        choices=['memory', 'streaming'],
+                        default='memory',
+                        help='"memory" loads the train-start/count and eval-start/count windows of '
+                             'the training data into memory, from the columnar copy in the '
+                             'transformed data dir when there is one, from the training CSV '
+                             'otherwise. "streaming" reads --train-files and --eval-files batch '
+                             'by batch with tf.data.')
+
+    parser.add_argument('--train-files',
+                        type=str,
+                        help='File pattern of the CSV or TFRecord training data in streaming mode. '
+                             'Files ending in .csv or .csv.gz are read as CSV, other files as '
+                             'TFRecord. Files ending in .gz are read as GZIP.')
+
+    parser.add_argument('--eval-files',
+                        type=str,
+                        help='File pattern of the CSV or TFRecord eval data in streaming mode.')
+
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=1000,
+                        help='Number of examples per batch in streaming mode.')
+
+    parser.add_argument('--n-batches-per-layer',
+                        type=int,
+                        default=10,
+                        help='Number of batches whose statistics are accumulated to grow one '
+                             'layer of a tree in streaming mode.')
+
+    parser.add_argument('--num-buckets',
+                        type=int,
+                        default=100,
+                        help='Number of quantile buckets each feature is bucketized into. The '
+                             'streaming mode saves the boundaries in the transformed data dir and '
+                             'reuses them while the train files are unchanged.')
+
     parser.add_argument('--optimizer',
                         choices=['Adam', 'SGD', 'Adagrad'],
                         default='Adagrad',
@@ -79,8 +139,8 @@ def parse_arguments():
                         help='comma separated hidden layer sizes. For example "200,100,50".')
     parser.add_argument('--steps',
                         type=int,
-                        help='Maximum number of training steps to perform. If unspecified, will '
-                             'honor epochs.')
+                        help='Maximum number of training steps to perform in streaming mode. If '
+                             'unspecified, will honor epochs.')
     parser.add_argument('--epochs',
                         type=int,
                         help='Maximum number of training data epochs on which to train. If '
@@ -101,6 +161,8 @@ def parse_arguments():
                         help='The name of the column to predict in training data.')
 
     args = parser.parse_args()
+    if args.input_mode == 'streaming' and not (args.train_files and args.eval_files):
+        parser.error('--train-files and --eval-files are required in streaming mode.')
 
     return args
 
@@ -124,7 +186,56 @@ def read_ct_data(train_start, train_count, eval_start, eval_count, data_path):
             data[eval_start:eval_start + eval_count])
 
 
-def make_inputs_from_np_arrays(features_np, label_np):
+def load_array(path):
+    """Loads a .npy array, memory-mapped when the file is local."""
+    if path.startswith('gs://'):
+        with file_io.FileIO(path, 'rb') as f:
+            return np.load(io.BytesIO(f.read()))
+    return np.load(path, mmap_mode='r')
+
+
+def read_columnar_data(train_start, train_count, eval_start, eval_count, data_dir):
+    """
+    Read the train and eval windows from the columnar copy of the training data
+    written by the transform step, without parsing any CSV
+    :return: The required division between train and test set, laid out like
+             the result of read_ct_data, target first
+    """
+    features = load_array(os.path.join(data_dir, 'features.npy'))
+    target = load_array(os.path.join(data_dir, 'target.npy'))
+
+    def window(start, count):
+        return np.hstack([target[start:start + count, np.newaxis].astype(np.float32),
+                          features[start:start + count]])
+
+    return window(train_start, train_count), window(eval_start, eval_count)
+
+
+def get_bucket_boundaries(features_np, num_buckets=100):
+    """Returns bucket boundaries for every feature column by percentiles,
+    computed for all the columns at once."""
+    percentiles = np.percentile(features_np, np.arange(num_buckets) * 100.0 / num_buckets, axis=0)
+    return [np.unique(percentiles[:, i]).tolist() for i in range(features_np.shape[1])]
+
+
+def make_bucketized_columns(feature_names, boundaries):
+    """Returns a tf.feature_column.BucketizedColumn per float32 feature."""
+    source_columns = [
+        tf.feature_column.numeric_column(
+            feature_name, dtype=tf.float32,
+            default_value=0.0)
+        for feature_name in feature_names
+    ]
+
+    return [
+        tf.feature_column.bucketized_column(
+            source_columns[i],
+            boundaries=boundaries[i])
+        for i in range(len(feature_names))
+    ]
+
+
+def make_inputs_from_np_arrays(features_np, label_np, num_buckets=100):
     """Makes and returns input_fn and feature_columns from numpy arrays.
     The generated input_fn will return tf.data.Dataset of feature dictionary and a
     label, and feature_columns will consist of the list of
@@ -135,6 +246,7 @@ def make_inputs_from_np_arrays(features_np, label_np):
       features_np: A numpy ndarray (shape=[batch_size, num_features]) for
           float32 features.
       label_np: A numpy ndarray (shape=[batch_size, 1]) for labels.
+      num_buckets: The number of quantile buckets per feature.
     Returns:
       input_fn: A function returning a Dataset of feature dict and label.
       feature_names: A list of feature names.
@@ -145,24 +257,8 @@ def make_inputs_from_np_arrays(features_np, label_np):
     # 1-based feature names.
     feature_names = ["feature_%02d" % (i + 1) for i in range(num_features)]
 
-    # Create source feature_columns and bucketized_columns.
-    def get_bucket_boundaries(feature):
-        """Returns bucket boundaries for feature by percentiles."""
-        return np.unique(np.percentile(feature, range(0, 100))).tolist()
-
-    source_columns = [
-        tf.feature_column.numeric_column(
-            feature_name, dtype=tf.float32,
-            default_value=0.0)
-        for feature_name in feature_names
-    ]
-
-    bucketized_columns = [
-        tf.feature_column.bucketized_column(
-            source_columns[i],
-            boundaries=get_bucket_boundaries(features_np_list[i]))
-        for i in range(num_features)
-    ]
+    bucketized_columns = make_bucketized_columns(
+        feature_names, get_bucket_boundaries(features_np, num_buckets))
 
     # Make an input_fn that extracts source features.
     def input_fn():
@@ -197,25 +293,228 @@ def make_eval_inputs_from_np_arrays(features_np, label_np):
     return input_fn
 
 
+def _get_compression_type(file_name):
+    return 'GZIP' if file_name.endswith('.gz') else ''
+
+
+def _is_csv(file_name):
+    """Tells whether a data file is CSV from its extension, .csv or .csv.gz.
+    Anything else, like the train-*.gz shards of the transform step, is TFRecord."""
+    if file_name.endswith('.gz'):
+        file_name = file_name[:-len('.gz')]
+    return file_name.endswith('.csv')
+
+
+def read_csv_header(file_name):
+    """Returns the column names in the header of a, possibly gzipped, CSV file."""
+    with file_io.FileIO(file_name, 'rb') as f:
+        if _get_compression_type(file_name):
+            f = gzip.GzipFile(fileobj=f)
+        return f.readline().decode('utf-8-sig').strip().split(',')
+
+
+def _get_schema_file(schema_path, data_dir):
+    """Returns schema_path, or the schema.json the transform step writes next
+    to its output when schema_path does not exist."""
+    if not file_io.file_exists(schema_path):
+        return os.path.join(data_dir, 'schema.json')
+    return schema_path
+
+
+def read_schema_columns(schema_path, data_dir):
+    """Returns the names of the NUMBER columns in a json schema file, or in the
+    schema.json the transform step writes next to its output when schema_path
+    does not exist."""
+    schema_path = _get_schema_file(schema_path, data_dir)
+    schema = json.loads(file_io.read_file_to_string(schema_path))
+    return [col_schema['name'] for col_schema in schema if col_schema['type'] == 'NUMBER']
+
+
+def make_streaming_input_fn(file_pattern, schema_path, batch_size, num_epochs=None,
+                            shuffle=True):
+    """Makes and returns an input_fn streaming batches from CSV or TFRecord files.
+    The files are read in parallel with tf.data, so the data never has to fit in
+    memory. CSV files must have a header. TFRecord files hold tf.Examples with
+    one float feature per NUMBER column of the schema and an int64 target. Features
+    keep the file order and are named like the in-memory input, so both modes
+    export the same serving signatures.
+    Args:
+      file_pattern: a file pattern of .csv files, or of TFRecord files with any
+        other extension, .gz for GZIP.
+      schema_path: a json schema file listing the TFRecord columns.
+      batch_size: the number of examples per batch.
+      num_epochs: the number of passes over the data, None to repeat forever.
+      shuffle: whether to shuffle the files and the examples.
+    Returns:
+      input_fn: A function returning a Dataset of feature dict and label batches.
+      feature_names: A list of feature names.
+    """
+    files = sorted(file_io.get_matching_files(file_pattern))
+    if not files:
+        raise ValueError('No files match "%s".' % file_pattern)
+    compression_type = _get_compression_type(files[0])
+    is_csv = _is_csv(files[0])
+
+    columns = (read_csv_header(files[0]) if is_csv
+               else read_schema_columns(schema_path, os.path.dirname(files[0])))
+    feature_columns = [name for name in columns if name not in (ID_COLUMN, TARGET_COLUMN)]
+    # 1-based feature names.
+    feature_names = ["feature_%02d" % (i + 1) for i in range(len(feature_columns))]
+
+    if is_csv:
+        record_defaults = [[''] if name == ID_COLUMN else [0.0] for name in columns]
+
+        def read_file(file_name):
+            return tf.data.TextLineDataset(file_name, compression_type=compression_type).skip(1)
+
+        def parse(records):
+            values = dict(zip(columns, tf.decode_csv(records, record_defaults)))
+            features = {feature_name: values[column]
+                        for feature_name, column in zip(feature_names, feature_columns)}
+            return features, tf.expand_dims(tf.cast(values[TARGET_COLUMN], tf.int32), 1)
+    else:
+        feature_spec = {column: tf.FixedLenFeature([], tf.float32, default_value=0.0)
+                        for column in feature_columns}
+        feature_spec[TARGET_COLUMN] = tf.FixedLenFeature([], tf.int64)
+
+        def read_file(file_name):
+            return tf.data.TFRecordDataset(file_name, compression_type=compression_type)
+
+        def parse(records):
+            values = tf.parse_example(records, feature_spec)
+            features = {feature_name: values[column]
+                        for feature_name, column in zip(feature_names, feature_columns)}
+            return features, tf.expand_dims(tf.cast(values[TARGET_COLUMN], tf.int32), 1)
+
+    def input_fn():
+        """Returns batches of features as a dictionary of tensors, and a label."""
+        dataset = tf.data.Dataset.from_tensor_slices(files)
+        if shuffle:
+            dataset = dataset.shuffle(len(files))
+        dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+            read_file, cycle_length=min(len(files), 8), sloppy=shuffle))
+        if shuffle:
+            dataset = dataset.shuffle(10 * batch_size)
+        dataset = dataset.repeat(num_epochs).batch(batch_size)
+        # Records are parsed a whole batch at a time.
+        dataset = dataset.map(parse, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    return input_fn, feature_names
+
+
+def sketch_files(files, schema_path, batch_size):
+    """Returns a QuantileSketch of the features of the given files, each file
+    being sketched in its own thread and the sketches merged."""
+
+    def sketch_file(file_name):
+        input_fn, feature_names = make_streaming_input_fn(
+            file_name, schema_path, batch_size, num_epochs=1, shuffle=False)
+        sketch = quantiles.QuantileSketch(len(feature_names))
+        with tf.Graph().as_default():
+            features, _ = input_fn().make_one_shot_iterator().get_next()
+            batch = tf.stack([features[feature_name] for feature_name in feature_names], axis=1)
+            with tf.Session() as sess:
+                while True:
+                    try:
+                        sketch.add(sess.run(batch))
+                    except tf.errors.OutOfRangeError:
+                        break
+        return sketch
+
+    pool = ThreadPool(min(len(files), 8))
+    try:
+        sketches = pool.map(sketch_file, files)
+    finally:
+        pool.close()
+        pool.join()
+    sketch = sketches[0]
+    for other in sketches[1:]:
+        sketch.merge(other)
+    return sketch
+
+
+def _bucket_boundaries_key(files, schema_path, num_buckets):
+    """Returns what the bucket boundaries of the files depend on: the name,
+    size and modification time of each file, the schema the TFRecord columns
+    are read with and the number of buckets."""
+    key = {'files': [], 'schema': None, 'num_buckets': num_buckets}
+    for file_name in files:
+        stat = file_io.stat(file_name)
+        key['files'].append([file_name, stat.length, stat.mtime_nsec])
+    if not _is_csv(files[0]):
+        schema_path = _get_schema_file(schema_path, os.path.dirname(files[0]))
+        key['schema'] = [schema_path, file_io.read_file_to_string(schema_path)]
+    return key
+
+
+def load_bucket_boundaries(transformed_data_dir, file_pattern, schema_path, batch_size,
+                           num_buckets):
+    """Returns the bucket boundaries of the features of the training files.
+    They are computed in one pass over the files with a QuantileSketch, and
+    saved as json in the transformed data dir. Later runs and trials reuse the
+    saved boundaries as long as the files, their size and modification time,
+    the schema and the number of buckets are the same.
+    Only the streaming mode saves and reuses boundaries. The memory mode
+    computes them from the training window it loads, on every run.
+    Args:
+      transformed_data_dir: the directory the boundaries are saved in.
+      file_pattern: a file pattern of the training files.
+      schema_path: a json schema file listing the TFRecord columns.
+      batch_size: the number of examples read at a time.
+      num_buckets: the number of buckets per feature.
+    Returns:
+      A list with the list of boundaries of each feature.
+    """
+    files = sorted(file_io.get_matching_files(file_pattern))
+    if not files:
+        raise ValueError('No files match "%s".' % file_pattern)
+    key = _bucket_boundaries_key(files, schema_path, num_buckets)
+    boundaries_path = os.path.join(transformed_data_dir, BUCKET_BOUNDARIES_FILE)
+    if file_io.file_exists(boundaries_path):
+        saved = json.loads(file_io.read_file_to_string(boundaries_path))
+        if saved.get('key') == key:
+            print("Reusing bucket boundaries from %s" % boundaries_path)
+            return saved['boundaries']
+
+    sketch = sketch_files(files, schema_path, batch_size)
+    boundaries = sketch.bucket_boundaries(num_buckets)
+    file_io.recursive_create_dir(transformed_data_dir)
+    file_io.write_string_to_file(boundaries_path, json.dumps({
+        'key': key,
+        'num_examples': sketch.count,
+        'boundaries': boundaries,
+    }))
+    return boundaries
+
+
 def _make_csv_serving_input_receiver_fn(column_names, column_defaults):
     """Returns serving_input_receiver_fn for csv.
     The input arguments are relevant to `tf.decode_csv()`.
+    Besides the default csv signatures, the exported model gets a
+    "tensor:predict" signature whose "inputs" is a float32 tensor of shape
+    [None, len(column_names)], so clients can send the features as they are
+    instead of formatting them as csv text to be parsed again in the graph.
     Args:
       column_names: a list of column names in the order within input csv.
       column_defaults: a list of default values with the same size of
-          column_names. Each entity must be either a list of one scalar, or an
-          empty list to denote the corresponding column is required.
-          e.g. [[""], [2.5], []] indicates the third column is required while
-              the first column must be string and the second must be float/double.
+          column_names. Each entity must be a list of one float, since all
+          columns are stacked into the dense tensor input.
     Returns:
-      a serving_input_receiver_fn that handles csv for serving.
+      a serving_input_receiver_fn that handles csv and dense tensors for serving.
     """
 
     def serving_input_receiver_fn():
         csv = tf.placeholder(dtype=tf.string, shape=[None], name="csv")
-        features = dict(zip(column_names, tf.decode_csv(csv, column_defaults)))
+        decoded = tf.stack(tf.decode_csv(csv, column_defaults), axis=1)
+        # Fed directly by the tensor signature, computed from csv otherwise.
+        dense = tf.placeholder_with_default(
+            decoded, shape=[None, len(column_names)], name="tensor")
+        features = {name: dense[:, i] for i, name in enumerate(column_names)}
         receiver_tensors = {"inputs": csv}
-        return tf.estimator.export.ServingInputReceiver(features, receiver_tensors)
+        receiver_tensors_alternatives = {TENSOR_RECEIVER_NAME: {"inputs": dense}}
+        return tf.estimator.export.ServingInputReceiver(
+            features, receiver_tensors, receiver_tensors_alternatives)
 
     return serving_input_receiver_fn
 
@@ -225,25 +524,48 @@ def main():
 
     args = parse_arguments()
 
-    train_data, eval_data = read_ct_data(args.train_start, args.train_count, args.eval_start, args.eval_count,
-                                         'gs://kubeflow-pipelines-demo/dataset/train.csv')
-
-    train_input_fn, feature_names, feature_columns = make_inputs_from_np_arrays(
-        features_np=train_data[:, 1:], label_np=train_data[:, 0:1])
-
-    eval_input_fn = make_eval_inputs_from_np_arrays(
-        features_np=eval_data[:, 1:], label_np=eval_data[:, 0:1])
+    if args.input_mode == 'streaming':
+        train_input_fn, feature_names = make_streaming_input_fn(
+            args.train_files, args.schema, args.batch_size, num_epochs=args.epochs)
+        eval_input_fn, _ = make_streaming_input_fn(
+            args.eval_files, args.schema, args.batch_size, num_epochs=1, shuffle=False)
+        boundaries = load_bucket_boundaries(args.transformed_data_dir, args.train_files,
+                                            args.schema, args.batch_size, args.num_buckets)
+        feature_columns = make_bucketized_columns(feature_names, boundaries)
+        n_batches_per_layer = args.n_batches_per_layer
+        max_steps = args.steps
+    else:
+        columnar_dir = os.path.join(args.transformed_data_dir, COLUMNAR_TRAIN_DIR)
+        if file_io.file_exists(os.path.join(columnar_dir, COLUMNAR_COLUMNS_FILE)):
+            train_data, eval_data = read_columnar_data(args.train_start, args.train_count,
+                                                       args.eval_start, args.eval_count,
+                                                       columnar_dir)
+        else:
+            train_data, eval_data = read_ct_data(args.train_start, args.train_count,
+                                                 args.eval_start, args.eval_count,
+                                                 'gs://kubeflow-pipelines-demo/dataset/train.csv')
+
+        train_input_fn, feature_names, feature_columns = make_inputs_from_np_arrays(
+            features_np=train_data[:, 1:], label_np=train_data[:, 0:1],
+            num_buckets=args.num_buckets)
+
+        eval_input_fn = make_eval_inputs_from_np_arrays(
+            features_np=eval_data[:, 1:], label_np=eval_data[:, 0:1])
+        # The whole training window is a single batch.
+        n_batches_per_layer = 1
+        # Trains until n_trees are grown, --steps only applies to streaming.
+        max_steps = None
 
     print("Training starting...")
     classifier = tf.estimator.BoostedTreesClassifier(
         feature_columns,
-        n_batches_per_layer=1,
+        n_batches_per_layer=n_batches_per_layer,
         model_dir=args.job_dir,
         n_trees=args.n_trees,
         max_depth=args.max_depth,
         learning_rate=args.learning_rate)
 
-    classifier.train(train_input_fn)
+    classifier.train(train_input_fn, max_steps=max_steps)
 
     print("Training Finished Successfully...")
 
@@ -0,0 +1,116 @@
+"""
+Mergeable quantile sketch computing the bucket boundaries of all features in
+one pass over the data, without holding the feature columns in memory.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class QuantileSketch(object):
+    """Approximate quantiles of every column of a stream of [n, F] batches.
+
+    The sketch keeps, per feature, at most 2 * size weighted values. When it
+    grows past that it is compressed back to size values of equal weight
+    placed at evenly spaced quantiles, which bounds the rank error of a
+    compression by total_weight / size. Sketches of different shards can be
+    merged, so boundaries of a sharded dataset are computed shard by shard.
+    The extreme values of each feature are tracked exactly.
+
+    Values and weights are stored feature-major, as [F, k] arrays, so every
+    feature is sorted and searched in contiguous memory, and all features at
+    once through flat indices.
+    """
+
+    def __init__(self, num_features, size=2000):
+        self.num_features = num_features
+        self.size = size
+        self.values = np.zeros([num_features, 0], dtype=np.float64)
+        self.weights = np.zeros([num_features, 0], dtype=np.float64)
+        self.mins = np.full(num_features, np.inf)
+        self.maxs = np.full(num_features, -np.inf)
+        self.count = 0
+
+    def add(self, batch):
+        """Adds a [n, num_features] batch of examples, each of weight 1."""
+        batch = np.asarray(batch, dtype=np.float64).reshape(-1, self.num_features)
+        if not len(batch):
+            return
+        self.mins = np.minimum(self.mins, batch.min(axis=0))
+        self.maxs = np.maximum(self.maxs, batch.max(axis=0))
+        self.count += len(batch)
+        self._extend(batch.T, np.ones(batch.T.shape))
+
+    def merge(self, other):
+        """Adds the summary of another sketch of the same features."""
+        if other.num_features != self.num_features:
+            raise ValueError('Cannot merge sketches of %d and %d features.' %
+                             (self.num_features, other.num_features))
+        if not other.count:
+            return
+        self.mins = np.minimum(self.mins, other.mins)
+        self.maxs = np.maximum(self.maxs, other.maxs)
+        self.count += other.count
+        self._extend(other.values, other.weights)
+
+    def _extend(self, values, weights):
+        self.values = np.concatenate([self.values, values], axis=1)
+        self.weights = np.concatenate([self.weights, weights], axis=1)
+        if self.values.shape[1] > 2 * self.size:
+            self._compress()
+
+    def _flat_offsets(self, k):
+        """Returns the [F, 1] offsets of the rows of an [F, k] array in its ravel."""
+        return (k * np.arange(self.num_features))[:, np.newaxis]
+
+    def _sorted(self):
+        """Returns the values and cumulative weights sorted within each feature."""
+        k = self.values.shape[1]
+        order = (np.argsort(self.values, axis=1) + self._flat_offsets(k)).ravel()
+        values = self.values.ravel()[order].reshape(self.num_features, k)
+        weights = self.weights.ravel()[order].reshape(self.num_features, k)
+        return values, np.cumsum(weights, axis=1)
+
+    def _select(self, values, cum_weights, ranks):
+        """Returns, for every feature, the value at which the cumulative weight
+        first reaches each of the [F, q] ranks.
+
+        All features are searched with a single np.searchsorted by adding
+        j times an upper bound of any total weight to the cumulative weights
+        of feature j, which keeps the flattened array sorted.
+        """
+        k = values.shape[1]
+        bound = cum_weights[:, -1].max() + 1
+        shift = bound * np.arange(self.num_features)[:, np.newaxis]
+        indices = np.searchsorted((cum_weights + shift).ravel(), (ranks + shift).ravel())
+        indices = indices.reshape(self.num_features, -1) - self._flat_offsets(k)
+        indices = np.minimum(indices, k - 1) + self._flat_offsets(k)
+        return values.ravel()[indices]
+
+    def _compress(self):
+        values, cum_weights = self._sorted()
+        totals = cum_weights[:, -1:]
+        ranks = (np.arange(self.size) + 0.5) / self.size * totals
+        self.values = self._select(values, cum_weights, ranks)
+        self.weights = np.repeat(totals / self.size, self.size, axis=1)
+
+    def quantiles(self, qs):
+        """Returns a [len(qs), num_features] array of the approximate qs
+        quantiles, qs being fractions in [0, 1]."""
+        if not self.count:
+            raise ValueError('Cannot compute quantiles of an empty sketch.')
+        values, cum_weights = self._sorted()
+        qs = np.asarray(qs, dtype=np.float64)
+        result = self._select(values, cum_weights, qs * cum_weights[:, -1:]).T
+        # The extremes are known exactly.
+        result[qs <= 0] = self.mins
+        result[qs >= 1] = self.maxs
+        return result
+
+    def bucket_boundaries(self, num_buckets=100):
+        """Returns, per feature, the list of unique boundaries of num_buckets
+        buckets of about equal size, like percentiles 0 to 99 of the data."""
+        boundaries = self.quantiles(np.arange(num_buckets) / num_buckets)
+        return [np.unique(boundaries[:, i]).tolist() for i in range(self.num_features)]
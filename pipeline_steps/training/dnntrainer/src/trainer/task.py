@@ -112,6 +112,12 @@ def make_tft_input_metadata(schema):
     return dataset_metadata.DatasetMetadata(dataset_schema.Schema(tft_schema))
 
 
+def _gzip_tfrecord_reader():
+    """Returns a reader of the GZIP TFRecord shards written by the transform step."""
+    return tf.TFRecordReader(options=tf.python_io.TFRecordOptions(
+        tf.python_io.TFRecordCompressionType.GZIP))
+
+
 def make_training_input_fn(transformed_data_dir, mode, batch_size, target_name, num_epochs=None):
     """Creates an input function reading from transformed data.
     Args:
@@ -132,7 +138,7 @@ def make_training_input_fn(transformed_data_dir, mode, batch_size, target_name,
         epochs = 1 if mode == 'eval' else num_epochs
         transformed_features = tf.contrib.learn.io.read_batch_features(
             os.path.join(transformed_data_dir, mode + '-*'),
-            batch_size, transformed_feature_spec, tf.TFRecordReader, num_epochs=epochs)
+            batch_size, transformed_feature_spec, _gzip_tfrecord_reader, num_epochs=epochs)
 
         # Extract features and label from the transformed tensors.
         transformed_labels = transformed_features.pop(target_name)
@@ -0,0 +1,75 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from trainer.quantiles import QuantileSketch
+import numpy as np
+import unittest
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+  def _max_rank_error(self, data, quantiles, qs):
+    errors = []
+    for i in range(data.shape[1]):
+      column = np.sort(data[:, i])
+      ranks = np.searchsorted(column, quantiles[:, i]) / float(len(column))
+      errors.append(np.abs(ranks - qs).max())
+    return max(errors)
+
+  def test_exact_below_size(self):
+    """Test quantiles of a sketch that was never compressed"""
+
+    sketch = QuantileSketch(2)
+    sketch.add([[1, 5], [2, 6], [3, 7]])
+    np.testing.assert_array_equal(
+        sketch.quantiles([0, 0.5, 1]), [[1, 5], [2, 6], [3, 7]])
+
+  def test_rank_error(self):
+    """Test quantiles of a compressed sketch are within the rank error bound"""
+
+    data = np.random.RandomState(0).randn(50000, 5) * [1, 10, 100, 1000, 0.1]
+    sketch = QuantileSketch(5, size=500)
+    for i in range(0, len(data), 1000):
+      sketch.add(data[i:i + 1000])
+    qs = np.arange(100) / 100.0
+    self.assertLess(self._max_rank_error(data, sketch.quantiles(qs), qs), 0.01)
+
+  def test_merge(self):
+    """Test merging sketches of shards is as accurate as one sketch"""
+
+    data = np.random.RandomState(1).exponential(size=(40000, 3))
+    sketches = [QuantileSketch(3, size=500) for _ in range(4)]
+    for i, sketch in enumerate(sketches):
+      sketch.add(data[i * 10000:(i + 1) * 10000])
+    for other in sketches[1:]:
+      sketches[0].merge(other)
+    self.assertEqual(sketches[0].count, len(data))
+    qs = np.arange(100) / 100.0
+    self.assertLess(self._max_rank_error(data, sketches[0].quantiles(qs), qs), 0.01)
+    np.testing.assert_array_equal(sketches[0].quantiles([0, 1]), [data.min(axis=0), data.max(axis=0)])
+
+  def test_bucket_boundaries(self):
+    """Test boundaries are unique and sorted per feature"""
+
+    sketch = QuantileSketch(2)
+    sketch.add(np.stack([np.arange(1000), np.zeros(1000)], axis=1))
+    boundaries = sketch.bucket_boundaries(10)
+    self.assertEqual(boundaries[0], sorted(set(boundaries[0])))
+    self.assertEqual(len(boundaries[0]), 10)
+    self.assertEqual(boundaries[1], [0.0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,110 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Compares the rows/sec of the per-row prediction loop with the batched
+# scoring engine of the local predict step.
+# Usage:
+# python benchmark_predict.py \
+#   --model=gs://kubeflow-pipelines-demo/model \
+#   --data=gs://kubeflow-pipelines-demo/dataset/test.csv \
+#   --rows=2000 \
+#   --batchsizes=32,256,1024
+
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+from tensorflow.contrib import predictor
+from tensorflow.python.lib.io import file_io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import predict
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model',
+                        type=str,
+                        required=True,
+                        help='GCS or local path of the trainer output directory.')
+    parser.add_argument('--data',
+                        type=str,
+                        required=True,
+                        help='GCS or local path of the test CSV file.')
+    parser.add_argument('--rows',
+                        type=int,
+                        default=2000,
+                        help='Number of transactions to score.')
+    parser.add_argument('--batchsizes',
+                        type=str,
+                        default='32,256,1024',
+                        help='Comma separated batch sizes for the batched engine.')
+    return parser.parse_args()
+
+
+def score_per_row(predict_fn, df, data):
+    """The original loop: one CSV string and one predictor call per row."""
+    results = pd.DataFrame(columns=list(data.columns.values) + ['target', 'predicted', 'false', 'true'])
+    for index, row in data.iterrows():
+        tnx_info = [','.join(str(e) for e in data.iloc[index].values)]
+        prediction = predict_fn({"inputs": tnx_info})
+        ob = list(row.values)
+        ob.append(df.iloc[index]['target'])
+        ob.append((str(prediction['scores'][0][0] < prediction['scores'][0][1])).lower())
+        ob.append(prediction['scores'][0][0])
+        ob.append(prediction['scores'][0][1])
+        results.loc[index] = ob
+    return results
+
+
+def score_batched(predict_fn, df, data, batch_size):
+    scores = predict.score_block(predict_fn, data.values, batch_size)
+    return predict.add_prediction_columns(data.copy(), df['target'].values, scores)
+
+
+def timed(name, rows, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print('%-24s %8d rows %10.2f s %12.1f rows/sec' % (name, rows, elapsed, rows / elapsed))
+
+
+def main():
+    args = parse_arguments()
+    export_parent_dir = os.path.join(args.model, 'export', 'export')
+    model_export_dir = os.path.join(export_parent_dir, file_io.list_directory(export_parent_dir)[0])
+    csv_predict_fn = predictor.from_saved_model(model_export_dir)
+    block_predict_fn = predict.load_predictor(model_export_dir)
+
+    with file_io.FileIO(args.data, 'r') as f:
+        df = pd.read_csv(f, nrows=args.rows)
+    data = df.drop(['ID_code', 'target'], axis=1)
+    rows = len(data)
+
+    timed('per-row loop', rows, lambda: score_per_row(csv_predict_fn, df, data))
+    for batch_size in [int(x) for x in args.batchsizes.split(',')]:
+        timed('batched (batch=%d)' % batch_size, rows,
+              lambda: score_batched(block_predict_fn, df, data, batch_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Compares the per-request latency of the csv and the dense tensor serving
+# signatures of a boosted trees model, client side formatting included.
+# Usage:
+# python benchmark_signatures.py \
+#   --model=gs://kubeflow-pipelines-demo/model \
+#   --data=gs://kubeflow-pipelines-demo/dataset/test.csv \
+#   --requests=200 \
+#   --batchsizes=1,32,256
+
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from tensorflow.contrib import predictor
+from tensorflow.python.lib.io import file_io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import predict
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model',
+                        type=str,
+                        required=True,
+                        help='GCS or local path of the trainer output directory.')
+    parser.add_argument('--data',
+                        type=str,
+                        required=True,
+                        help='GCS or local path of the test CSV file.')
+    parser.add_argument('--requests',
+                        type=int,
+                        default=200,
+                        help='Number of requests per signature and batch size.')
+    parser.add_argument('--batchsizes',
+                        type=str,
+                        default='1,32,256',
+                        help='Comma separated number of transactions per request.')
+    return parser.parse_args()
+
+
+def measure(name, batch_size, requests, fn):
+    latencies = []
+    for _ in range(requests):
+        start = time.time()
+        fn()
+        latencies.append((time.time() - start) * 1000)
+    print('%-8s batch=%-5d p50 %8.3f ms  p99 %8.3f ms' % (
+        name, batch_size, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+def main():
+    args = parse_arguments()
+    export_parent_dir = os.path.join(args.model, 'export', 'export')
+    model_export_dir = os.path.join(export_parent_dir, file_io.list_directory(export_parent_dir)[0])
+    csv_predict_fn = predictor.from_saved_model(model_export_dir)
+    tensor_predict_fn = predictor.from_saved_model(
+        model_export_dir, signature_def_key=predict.TENSOR_SIGNATURE_KEY)
+
+    with file_io.FileIO(args.data, 'r') as f:
+        df = pd.read_csv(f)
+    features = df.drop(['ID_code', 'target'], axis=1).values.astype(np.float32)
+
+    for batch_size in [int(x) for x in args.batchsizes.split(',')]:
+        block = features[:batch_size]
+        measure('csv', batch_size, args.requests,
+                lambda: csv_predict_fn({"inputs": [','.join(str(e) for e in row) for row in block]}))
+        measure('tensor', batch_size, args.requests,
+                lambda: tensor_predict_fn({"inputs": block}))
+
+
+if __name__ == '__main__':
+    main()
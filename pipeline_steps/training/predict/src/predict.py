@@ -17,16 +17,40 @@
 import apache_beam as beam
 import argparse
 import datetime
+import io
 import json
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import tensorflow as tf
 from tensorflow.python.lib.io import file_io
 from tensorflow.contrib import predictor
+from tensorflow.python.tools import saved_model_utils
 import numpy as np
 
 import pandas as pd
 from google.cloud import storage
 
+# The model parses its CSV input as float32, so nine significant digits are
+# enough to round-trip every feature value exactly.
+CSV_FLOAT_FORMAT = '%.9g'
+
+# Signature of models exported with a dense float32 tensor input.
+TENSOR_SIGNATURE_KEY = 'tensor:predict'
+
+# Columns of the test data that are not model features.
+ID_COLUMN = 'ID_code'
+TARGET_COLUMN = 'target'
+
+# Description of the .npy arrays in a columnar copy of the test data written
+# by the transform step, see preprocessing/tft/src/transform.py.
+COLUMNAR_COLUMNS_FILE = 'columns.json'
+
+# Predictor of a sharded prediction worker, loaded once per process.
+_worker_predict_fn = None
+
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -39,7 +63,8 @@ def parse_arguments():
     parser.add_argument('--data',
                         type=str,
                         required=True,
-                        help='GCS or local path of test file patterns.')
+                        help='GCS or local path of test file patterns, or of a directory with the '
+                             'columnar copy of the test data written by the transform step.')
     parser.add_argument('--schema',
                         type=str,
                         required=True,
@@ -63,6 +88,14 @@ def parse_arguments():
                         type=int,
                         default=32,
                         help='Batch size used in prediction.')
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=10000,
+                        help='Number of rows read and scored at a time. 0 reads the whole file at once.')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes scoring shards of the test data in parallel.')
 
     args = parser.parse_args()
     return args
@@ -81,74 +114,302 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name):
         destination_blob_name))
 
 
-def run_predict(output_dir, data_path, model_export_dir):
-    """Run predictions with given model using DataFlow.
+def serialize_rows(features):
+    """Formats a block of feature rows as CSV lines in a single pass.
     Args:
-      output_dir: output folder
-      data_path: test data file path.
-      schema: schema list.
-      target_name: target column name.
-      model_export_dir: GCS or local path of exported model trained with tft preprocessed data.
-      project: the project to run dataflow in.
-      local: whether the job should be local or cloud.
-      batch_size: batch size when running prediction.
+      features: numpy array of shape [N, num_features].
+    Returns:
+      A list of N CSV strings, one per transaction.
+    """
+    text = pd.DataFrame(features).to_csv(header=False, index=False,
+                                         float_format=CSV_FLOAT_FORMAT)
+    return text.splitlines()
+
+
+def load_predictor(model_export_dir, config=None):
+    """Loads the exported model as a function from a feature block to scores.
+    Models that export the dense tensor signature are fed the float32 features
+    as they are; older models get them formatted as CSV lines.
+    Args:
+      model_export_dir: GCS or local path of the exported saved model.
+      config: optional tf.ConfigProto for the predictor session.
+    Returns:
+      A function taking a [N, num_features] array and returning [N, 2] scores.
     """
-    predict_fn = predictor.from_saved_model(model_export_dir)
+    meta_graph = saved_model_utils.get_meta_graph_def(model_export_dir, 'serve')
+    if TENSOR_SIGNATURE_KEY in meta_graph.signature_def:
+        predict_fn = predictor.from_saved_model(
+            model_export_dir, signature_def_key=TENSOR_SIGNATURE_KEY, config=config)
+        return lambda features: predict_fn(
+            {"inputs": features.astype(np.float32, copy=False)})['probabilities']
+
+    predict_fn = predictor.from_saved_model(model_export_dir, config=config)
+    return lambda features: predict_fn({"inputs": serialize_rows(features)})['scores']
+
+
+def score_block(predict_fn, features, batch_size):
+    """Scores a block of transactions, batch_size rows per predictor call.
+    Args:
+      predict_fn: function returned by load_predictor.
+      features: numpy array of shape [N, num_features].
+      batch_size: number of transactions sent to the predictor at once.
+    Returns:
+      A float32 numpy array of shape [N, 2] with the false/true scores.
+    """
+    num_rows = features.shape[0]
+    scores = np.empty((num_rows, 2), dtype=np.float32)
+    for start in range(0, num_rows, batch_size):
+        end = min(start + batch_size, num_rows)
+        scores[start:end] = predict_fn(features[start:end])
+    return scores
+
+
+def add_prediction_columns(data, target, scores):
+    """Appends target, predicted and score columns to the feature frame."""
+    data['target'] = target
+    data['predicted'] = np.where(scores[:, 0] < scores[:, 1], 'true', 'false')
+    data['false'] = scores[:, 0]
+    data['true'] = scores[:, 1]
+    return data
+
 
-    df = pd.read_csv(data_path)
+def is_columnar(data_path):
+    """Whether data_path is a directory with a columnar copy of the test data."""
+    return file_io.file_exists(os.path.join(data_path, COLUMNAR_COLUMNS_FILE))
 
-    data = df.drop(['ID_code', 'target'], axis=1)
 
-    columns = list(data.columns.values)
+def load_array(path):
+    """Loads a .npy array, memory-mapped when the file is local."""
+    if path.startswith('gs://'):
+        with file_io.FileIO(path, 'rb') as f:
+            return np.load(io.BytesIO(f.read()))
+    return np.load(path, mmap_mode='r')
 
-    output_schema = []
 
-    for column in columns:
-        output_schema.append({'name': column, 'type': 'NUMBER'})
+def read_header(data_path):
+    """Returns the column names from the header of the test data."""
+    if is_columnar(data_path):
+        columns = json.loads(file_io.read_file_to_string(
+            os.path.join(data_path, COLUMNAR_COLUMNS_FILE)))
+        return [ID_COLUMN, TARGET_COLUMN] + columns['features']
+    return list(pd.read_csv(data_path, nrows=0).columns)
 
+
+def get_feature_columns(header):
+    return [x for x in header if x not in (ID_COLUMN, TARGET_COLUMN)]
+
+
+def read_chunks(data, feature_columns, chunk_size, names=None):
+    """Reads the test data in chunks of at most chunk_size rows.
+    Only the feature and target columns are parsed, features as float32, so
+    memory is bounded by the chunk size rather than the file size.
+    Args:
+      data: test data file path or binary file object.
+      feature_columns: names of the feature columns.
+      chunk_size: rows per chunk, or 0 to read the whole file as one chunk.
+      names: column names, for data that does not start with a header line.
+    Returns:
+      An iterable of DataFrames.
+    """
+    dtype = dict((x, np.float32) for x in feature_columns)
+    reader = pd.read_csv(data,
+                         header=None if names else 'infer',
+                         names=names,
+                         usecols=feature_columns + [TARGET_COLUMN],
+                         dtype=dtype,
+                         chunksize=chunk_size or None)
+    if not chunk_size:
+        return [reader]
+    return reader
+
+
+def read_columnar_chunks(data_dir, feature_columns, chunk_size, start=0, end=None):
+    """Reads rows [start, end) of a columnar copy of the test data in chunks of
+    at most chunk_size rows, without parsing any text.
+    Returns:
+      An iterable of DataFrames, like read_chunks.
+    """
+    features = load_array(os.path.join(data_dir, 'features.npy'))
+    target = load_array(os.path.join(data_dir, 'target.npy'))
+    end = len(features) if end is None else end
+    step = chunk_size or max(end - start, 1)
+    for offset in range(start, end, step):
+        chunk = pd.DataFrame(np.asarray(features[offset:min(offset + step, end)]),
+                             columns=feature_columns)
+        chunk[TARGET_COLUMN] = target[offset:min(offset + step, end)]
+        yield chunk
+
+
+def write_predictions(predict_fn, chunks, columns, batch_size, f):
+    """Scores each chunk and appends the results to f as CSV lines.
+    Returns:
+      The number of rows written.
+    """
+    num_rows = 0
+    for chunk in chunks:
+        target = chunk.pop(TARGET_COLUMN).values
+        scores = score_block(predict_fn, chunk.values, batch_size)
+        results = add_prediction_columns(chunk, target, scores)
+        results.to_csv(f, columns=columns, header=False, index=False)
+        num_rows += len(results)
+        logging.info('Scored %d rows.', num_rows)
+    return num_rows
+
+
+def get_output_schema(feature_columns):
+    output_schema = [{'name': x, 'type': 'NUMBER'} for x in feature_columns]
     output_schema.append({'name': 'target', 'type': 'CATEGORY'})
     output_schema.append({'name': 'predicted', 'type': 'CATEGORY'})
     output_schema.append({'name': 'false', 'type': 'NUMBER'})
     output_schema.append({'name': 'true', 'type': 'NUMBER'})
+    return output_schema
 
-    columns = columns + ['target', 'predicted', 'false', 'true']
 
-    results = pd.DataFrame(columns=columns)
+class ByteRangeReader(io.RawIOBase):
+    """Binary file object over the [start, end) byte range of a file."""
 
-    for index, row in data.iterrows():
-        target = df.iloc[index]['target']
-        tnx = data.iloc[index].values
-        tnx_info = [','.join(str(e) for e in tnx)]
-        prediction = predict_fn({"inputs": tnx_info})
-        prediction['source'] = target
-        print(prediction)
-        print(target)
+    def __init__(self, path, start, end):
+        self._file = file_io.FileIO(path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
 
-        ob = list(row.values)
+    def readable(self):
+        return True
 
-        ob.append(target)
+    def readinto(self, b):
+        data = self._file.read(min(len(b), self._remaining))
+        b[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
 
-        ob.append((str(prediction['scores'][0][0] < prediction['scores'][0][1])).lower())
-        ob.append(prediction['scores'][0][0])
-        ob.append(prediction['scores'][0][1])
+    def close(self):
+        self._file.close()
+        super(ByteRangeReader, self).close()
 
-        results.loc[index] = ob
 
-    print(results.head())
+def get_shards(data_path, num_shards):
+    """Splits the rows of the test data into byte ranges of similar size.
+    Every range starts at the beginning of a line, and the header line is
+    excluded, so each range can be parsed on its own.
+    Returns:
+      A list of (start, end) byte offsets, in file order.
+    """
+    size = file_io.stat(data_path).length
+    with file_io.FileIO(data_path, 'rb') as f:
+        f.readline()
+        offsets = [f.tell()]
+        for i in range(1, num_shards):
+            offset = offsets[0] + (size - offsets[0]) * i // num_shards
+            # Move to the start of the first line beginning at or after offset.
+            f.seek(max(offset, offsets[-1]) - 1)
+            f.readline()
+            offsets.append(f.tell())
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if start < end]
+
+
+def get_row_shards(num_rows, num_shards):
+    """Splits num_rows rows of a columnar copy into row ranges of similar size.
+    Returns:
+      A list of (start, end) row indices, in order.
+    """
+    offsets = [num_rows * i // num_shards for i in range(num_shards + 1)]
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if start < end]
+
+
+def _init_worker(model_export_dir):
+    global _worker_predict_fn
+    # One op thread per session, parallelism comes from the worker processes.
+    config = tf.ConfigProto(intra_op_parallelism_threads=1,
+                            inter_op_parallelism_threads=1)
+    _worker_predict_fn = load_predictor(model_export_dir, config=config)
+
+
+def _predict_shard(task):
+    """Scores one byte range, or row range of a columnar copy, of the test data
+    into a local part file."""
+    data_path, start, end, header, batch_size, chunk_size, part_path = task
+    feature_columns = get_feature_columns(header)
+    columns = [x['name'] for x in get_output_schema(feature_columns)]
+    if is_columnar(data_path):
+        with open(part_path, 'w') as f:
+            chunks = read_columnar_chunks(data_path, feature_columns, chunk_size, start, end)
+            write_predictions(_worker_predict_fn, chunks, columns, batch_size, f)
+        return part_path
+    reader = io.BufferedReader(ByteRangeReader(data_path, start, end))
+    with reader, open(part_path, 'w') as f:
+        chunks = read_chunks(reader, feature_columns, chunk_size, names=header)
+        write_predictions(_worker_predict_fn, chunks, columns, batch_size, f)
+    return part_path
+
+
+def run_sharded_predict(output_file, data_path, header, model_export_dir,
+                        batch_size, chunk_size, workers):
+    """Scores byte-range shards of the test data, or row-range shards of a
+    columnar copy, in a process pool.
+    Each worker loads the model once and writes its shards to local part
+    files, which are concatenated into output_file in input order.
+    """
+    if is_columnar(data_path):
+        num_rows = len(load_array(os.path.join(data_path, 'target.npy')))
+        shards = get_row_shards(num_rows, workers)
+    else:
+        shards = get_shards(data_path, workers)
+    part_dir = tempfile.mkdtemp()
+    tasks = [(data_path, start, end, header, batch_size, chunk_size,
+              os.path.join(part_dir, 'part-%05d' % i))
+             for i, (start, end) in enumerate(shards)]
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(model_export_dir,))
+    try:
+        part_paths = pool.map(_predict_shard, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    try:
+        with file_io.FileIO(output_file, 'w') as output:
+            for part_path in part_paths:
+                with open(part_path, 'r') as part:
+                    shutil.copyfileobj(part, output)
+    finally:
+        shutil.rmtree(part_dir)
+
+
+def run_predict(output_dir, data_path, model_export_dir, batch_size, chunk_size=0, workers=1):
+    """Run predictions with given model, streaming the test data in chunks.
+    Args:
+      output_dir: output folder
+      data_path: test data file path, or directory of its columnar copy.
+      model_export_dir: GCS or local path of exported model trained with tft preprocessed data.
+      batch_size: batch size when running prediction.
+      chunk_size: rows read and scored at a time, 0 to read the whole file.
+      workers: number of processes scoring shards of the data in parallel.
+    """
+    header = read_header(data_path)
+    feature_columns = get_feature_columns(header)
+    output_schema = get_output_schema(feature_columns)
+    columns = [x['name'] for x in output_schema]
 
     print(output_schema)
 
     schema_dir = os.path.join(output_dir, 'schema.json')
 
-    # with file_io.FileIO(schema_dir, 'w') as f:
-    #     json.dumps(output_schema, f)
-
     file_io.write_string_to_file(schema_dir, json.dumps(output_schema))
 
     output_file_prefix = os.path.join(output_dir, 'prediction_results')
 
+    if workers > 1:
+        run_sharded_predict(output_file_prefix, data_path, header, model_export_dir,
+                            batch_size, chunk_size, workers)
+        return columns
+
+    predict_fn = load_predictor(model_export_dir)
     with file_io.FileIO(output_file_prefix, 'w') as f:
-        results.to_csv(f, columns=columns, header=False, index=False)
+        if is_columnar(data_path):
+            chunks = read_columnar_chunks(data_path, feature_columns, chunk_size)
+        else:
+            chunks = read_chunks(data_path, feature_columns, chunk_size)
+        write_predictions(predict_fn, chunks, columns, batch_size, f)
 
     return columns
 
@@ -161,7 +422,8 @@ def main():
     export_parent_dir = os.path.join(args.model, 'export', 'export')
     model_export_dir = os.path.join(export_parent_dir, file_io.list_directory(export_parent_dir)[0])
 
-    columns = run_predict(args.output, args.data, model_export_dir)
+    columns = run_predict(args.output, args.data, model_export_dir, args.batchsize, args.chunksize,
+                          args.workers)
 
     prediction_results = os.path.join(args.output, 'prediction_results')
 
@@ -0,0 +1,191 @@
+# !/usr/bin/env python3
+
+"""An asyncio client that talks to tensorflow_model_server loaded with ctp model.
+
+Requests go through the grpc.aio API, so a single event loop keeps many
+predictions in flight without a thread per request. Requests and responses are
+built by the same helpers as the synchronous client in ctp_client.
+"""
+
+import asyncio
+import weakref
+
+import grpc
+import numpy as np
+from grpc import aio
+from tensorflow_serving.apis import prediction_service_pb2_grpc
+
+from ctp_client import (CHANNEL_OPTIONS, CSV_SIGNATURE_NAME, _csv_models, _model_versions,
+                        is_missing_signature, make_predict_request, parse_predict_response)
+
+# aio channels are bound to the event loop that created them, so every loop
+# (one per ASGI worker) keeps its own pool keyed by (server_host, server_port).
+_channels = weakref.WeakKeyDictionary()
+
+
+def get_stub(server_host, server_port):
+    """
+    Return the PredictionService stub of the pooled channel to a model server,
+    opening a new channel if there is none or the current one has failed
+
+    :param server_host: the address of the TensorFlow server
+    :param server_port: the port used by the server
+    :return:            the PredictionService stub
+    """
+    channels = _channels.setdefault(asyncio.get_event_loop(), {})
+    key = (server_host, server_port)
+    pooled = channels.get(key)
+    if pooled is not None:
+        state = pooled[0].get_state(try_to_connect=False)
+        if state in (grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+                     grpc.ChannelConnectivity.SHUTDOWN):
+            asyncio.ensure_future(pooled[0].close())
+            pooled = None
+    if pooled is None:
+        channel = aio.insecure_channel('%s:%d' % (server_host, server_port),
+                                       options=CHANNEL_OPTIONS)
+        pooled = (channel, prediction_service_pb2_grpc.PredictionServiceStub(channel))
+        channels[key] = pooled
+    return pooled[1]
+
+
+def _evict_stub(server_host, server_port, stub):
+    channels = _channels.get(asyncio.get_event_loop(), {})
+    pooled = channels.get((server_host, server_port))
+    if pooled is not None and pooled[1] is stub:
+        del channels[(server_host, server_port)]
+        asyncio.ensure_future(pooled[0].close())
+
+
+async def predict(request, server_host, server_port, timeout):
+    """
+    Send a PredictRequest over the pooled channel, reconnecting once if the
+    server became unavailable
+
+    :return: the PredictResponse
+    """
+    stub = get_stub(server_host, server_port)
+    try:
+        result = await stub.Predict(request, timeout=timeout)
+    except grpc.RpcError as e:
+        if e.code() != grpc.StatusCode.UNAVAILABLE:
+            raise
+        _evict_stub(server_host, server_port, stub)
+        result = await get_stub(server_host, server_port).Predict(request, timeout=timeout)
+    model = (server_host, server_port, request.model_spec.name)
+    _model_versions[model] = result.model_spec.version.value
+    return result
+
+
+async def get_predictions(features, server_host='127.0.0.1', server_port=8500, timeout=100.0,
+                          server_name='kfdemo-service'):
+    """
+    Retrieve predictions for a batch of transactions in a single request
+
+    :param features:    the annonymised transaction features, of shape [N, num_features]
+    :param server_host: the address of the TensorFlow server
+    :param server_port: the port used by the server
+    :param server_name: the name of the server
+    :param timeout:     the amount of time to wait for the predictions to complete
+    :return 0:          the class predicted for each transaction
+    :return 1:          the confidence scores for all classes, of shape [N, num_classes]
+    """
+    model = (server_host, server_port, server_name)
+    if model not in _csv_models:
+        request = make_predict_request(features, server_name)
+        try:
+            return parse_predict_response(await predict(request, server_host, server_port, timeout))
+        except grpc.RpcError as e:
+            if not is_missing_signature(e):
+                raise
+            _csv_models.add(model)
+
+    request = make_predict_request(features, server_name, CSV_SIGNATURE_NAME)
+    result = await predict(request, server_host, server_port, timeout)
+    return parse_predict_response(result)
+
+
+async def get_prediction(tnx, server_host='127.0.0.1', server_port=8500, timeout=100.0,
+                         server_name='kfdemo-service'):
+    """
+    Retrieve a prediction from a TensorFlow model server
+
+    :param tnx:         the annonymised transaction features as a float array
+    :param server_host: the address of the TensorFlow server
+    :param server_port: the port used by the server
+    :param server_name: the name of the server
+    :param timeout:     the amount of time to wait for a prediction to complete
+    :return 0:          the integer predicted in the transaction
+    :return 1:          the confidence scores for all classes
+    """
+    classes, scores = await get_predictions(np.atleast_2d(tnx), server_host, server_port,
+                                            timeout, server_name)
+    return classes[0], scores[0]
+
+
+class PredictionBatcher(object):
+    """
+    Coalesces concurrent single transaction predictions of one event loop into
+    batched requests, the asyncio counterpart of ctp_client.PredictionBatcher
+
+    Transactions are grouped by model server. While no request is in flight,
+    a lone transaction is sent right away, so batching only adds latency when
+    the server is already busy.
+    """
+
+    def __init__(self, max_batch_size=64, max_delay_ms=5):
+        """
+        :param max_batch_size: the maximum number of transactions per request
+        :param max_delay_ms:   how long to collect transactions before sending
+        """
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay_ms / 1000.0
+        self._pending = {}
+        self._timers = {}
+        self._in_flight = 0
+
+    async def predict(self, tnx, server_host='127.0.0.1', server_port=8500, timeout=100.0,
+                      server_name='kfdemo-service'):
+        """
+        Retrieve a prediction as part of a batched request, see get_prediction
+
+        :return 0: the integer predicted in the transaction
+        :return 1: the confidence scores for all classes
+        """
+        loop = asyncio.get_event_loop()
+        key = (server_host, server_port, server_name)
+        future = loop.create_future()
+        pendings = self._pending.setdefault(key, [])
+        pendings.append((tnx, timeout, future))
+        if self._in_flight == 0 or len(pendings) >= self._max_batch_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self._max_delay, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        pendings = self._pending.pop(key, None)
+        if pendings:
+            self._in_flight += 1
+            asyncio.ensure_future(self._send(key, pendings))
+
+    async def _send(self, key, pendings):
+        server_host, server_port, server_name = key
+        try:
+            features = np.stack([tnx for tnx, _, _ in pendings])
+            timeout = max(timeout for _, timeout, _ in pendings)
+            classes, scores = await get_predictions(features, server_host, server_port,
+                                                    timeout, server_name)
+        except Exception as e:  # pylint: disable=broad-except
+            for _, _, future in pendings:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for i, (_, _, future) in enumerate(pendings):
+                if not future.done():
+                    future.set_result((classes[i], scores[i]))
+        finally:
+            self._in_flight -= 1
@@ -0,0 +1,137 @@
+# !/usr/bin/env python3
+
+"""Asyncio version of flask_server, served by an ASGI server.
+
+Every request awaits its prediction on the grpc.aio channel of its worker
+instead of holding a thread, so one worker keeps many predictions in flight.
+Run it with several worker processes, e.g.
+
+  hypercorn --bind 0.0.0.0:8080 --workers 4 asgi_server:app
+"""
+
+import logging
+import os
+
+from quart import Quart, jsonify, render_template, request
+
+from aio_client import PredictionBatcher, get_prediction, get_predictions
+from ctp_client import (PredictionCache, decode_transactions, get_model_version, get_samples,
+                        random_transaction)
+
+app = Quart(__name__)
+
+# Concurrent page loads are coalesced into batched predictions when
+# MICRO_BATCH_DELAY_MS is set to a positive number of milliseconds.
+MICRO_BATCH_DELAY_MS = float(os.environ.get('MICRO_BATCH_DELAY_MS', '0'))
+MICRO_BATCH_SIZE = int(os.environ.get('MICRO_BATCH_SIZE', '64'))
+batcher = None
+if MICRO_BATCH_DELAY_MS > 0:
+    batcher = PredictionBatcher(max_batch_size=MICRO_BATCH_SIZE,
+                                max_delay_ms=MICRO_BATCH_DELAY_MS)
+
+# Predictions of repeated transactions are served from an LRU cache of
+# PREDICTION_CACHE_SIZE entries, expiring after PREDICTION_CACHE_TTL seconds.
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', '10000'))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', '300'))
+cache = None
+if PREDICTION_CACHE_SIZE > 0:
+    cache = PredictionCache(max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL)
+
+
+# load the sample transactions once per worker, before the first request
+@app.before_serving
+async def load_samples():
+    logging.info("Loading sample transactions.")
+    get_samples()
+
+
+# handle requests to the server
+@app.route("/")
+async def main():
+    # get url parameters for HTML template
+    name_arg = request.args.get('name', 'kfdemo-service')
+    addr_arg = request.args.get('addr', 'kfdemo-service')
+    port_arg = request.args.get('port', '9000')
+    args = {"name": name_arg, "addr": addr_arg, "port": port_arg}
+    logging.info("Request args: %s", args)
+
+    output = None
+    connection = {"text": "", "success": False}
+    try:
+
+        # Get random transaction
+        tnx, target = random_transaction()
+        # get prediction from TensorFlow server
+        predict_fn = batcher.predict if batcher else get_prediction
+        prediction = cache.get(tnx, addr_arg, int(port_arg), name_arg) if cache else None
+        if prediction is None:
+            prediction = await predict_fn(tnx, server_host=addr_arg,
+                                          server_port=int(port_arg),
+                                          timeout=10, server_name=name_arg)
+            if cache:
+                cache.put(tnx, prediction, addr_arg, int(port_arg), name_arg)
+        pred, scores = prediction
+        # if no exceptions thrown, server connection was a success
+        version = get_model_version(addr_arg, int(port_arg), name_arg)
+        connection["text"] = "Connected (model version: " + str(version) + ")"
+        connection["success"] = True
+        # parse class confidence scores from server prediction
+        scores_dict = []
+        for i in range(0, 2):
+            scores_dict += [{"index": str(i), "val": scores[i]}]
+        output = {"truth": target, "prediction": pred,
+                  "tnx_info": ','.join(map(str, tnx)), "scores": scores_dict}
+    except Exception as e:  # pylint: disable=broad-except
+        logging.info("Exception occured: %s", e)
+        # server connection failed
+        connection["text"] = "Exception making request: {0}".format(e)
+    # render results using HTML template
+    return await render_template('index.html', output=output,
+                                 connection=connection, args=args)
+
+
+# score many transactions with one batched request to the model server
+@app.route("/predict", methods=['POST'])
+async def predict_batch():
+    name_arg = request.args.get('name', 'kfdemo-service')
+    addr_arg = request.args.get('addr', 'kfdemo-service')
+    port_arg = request.args.get('port', '9000')
+
+    try:
+        features = decode_transactions(request.mimetype, await request.get_data(as_text=True))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        classes, scores = await get_predictions(features, server_host=addr_arg,
+                                                server_port=int(port_arg),
+                                                timeout=10, server_name=name_arg)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.info("Exception occured: %s", e)
+        return jsonify({"error": "Exception making request: {0}".format(e)}), 502
+
+    predictions = []
+    for pred, row_scores in zip(classes, scores):
+        predictions.append({"class": pred, "probabilities": row_scores.tolist()})
+    return jsonify({"predictions": predictions})
+
+
+# report the prediction cache counters
+@app.route("/cache")
+async def cache_stats():
+    if not cache:
+        return jsonify({"enabled": False})
+    stats = cache.stats()
+    stats["enabled"] = True
+    return jsonify(stats)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format=('%(levelname)s|%(asctime)s'
+                                '|%(pathname)s|%(lineno)d| %(message)s'),
+                        datefmt='%Y-%m-%dT%H:%M:%S',
+                        )
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info("Starting quart.")
+    app.run(debug=False, port=8080, host='0.0.0.0')
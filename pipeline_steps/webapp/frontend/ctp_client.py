@@ -7,21 +7,262 @@ from __future__ import print_function
 
 from __future__ import print_function
 
-from grpc.beta import implementations
+import grpc
 
 import tensorflow as tf
 from tensorflow_serving.apis import predict_pb2
-from tensorflow_serving.apis import prediction_service_pb2
+from tensorflow_serving.apis import prediction_service_pb2_grpc
+import numpy as np
 import pandas as pd
 
+import collections
+import hashlib
+import io
+import json
+import os
 import random
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-def get_prediction(tnx_info, server_host='127.0.0.1', server_port=8500, timeout=100.0, server_name='kfdemo-service'):
+# Signature taking the features as a dense float32 [N, num_features] tensor.
+TENSOR_SIGNATURE_NAME = 'tensor:predict'
+# Signature taking one CSV line of features per transaction, exported by
+# every model, including those trained before the tensor signature existed.
+CSV_SIGNATURE_NAME = 'predict'
+
+# Keepalive pings keep pooled connections open while idle and detect dead
+# ones before a request is sent on them.
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+]
+
+# Test transactions the demo samples from, either a CSV file or a directory
+# written by convert_samples, and how many of the leading ones are used.
+SAMPLES_PATH = os.environ.get('SAMPLES_PATH', '/home/test.csv')
+SAMPLE_POOL_SIZE = int(os.environ.get('SAMPLE_POOL_SIZE', '200'))
+
+# Sample pool loaded by get_samples.
+_samples = None
+_samples_lock = threading.Lock()
+
+# Pooled channels keyed by (server_host, server_port).
+_channels = {}
+_channels_lock = threading.Lock()
+
+# Model version of the last response, keyed by (server_host, server_port, server_name).
+_model_versions = {}
+
+# Models without the tensor signature, keyed by (server_host, server_port,
+# server_name). They are sent CSV requests without trying the tensor one.
+_csv_models = set()
+
+
+class PooledChannel(object):
+    """
+    A gRPC channel and PredictionService stub shared by all requests to one
+    model server. The channel connectivity is tracked so that a channel in
+    failure is replaced instead of being handed out again.
+    """
+
+    def __init__(self, server_host, server_port):
+        self.channel = grpc.insecure_channel('%s:%d' % (server_host, server_port),
+                                             options=CHANNEL_OPTIONS)
+        self.stub = prediction_service_pb2_grpc.PredictionServiceStub(self.channel)
+        self.state = None
+        self.channel.subscribe(self._on_state_change, try_to_connect=True)
+
+    def _on_state_change(self, state):
+        self.state = state
+
+    def is_healthy(self):
+        return self.state not in (grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+                                  grpc.ChannelConnectivity.SHUTDOWN)
+
+    def close(self):
+        self.channel.unsubscribe(self._on_state_change)
+        self.channel.close()
+
+
+def get_channel(server_host, server_port):
+    """
+    Return the pooled channel to a model server, creating it on first use or
+    when the pooled one has failed
+
+    :param server_host: the address of the TensorFlow server
+    :param server_port: the port used by the server
+    :return:            a PooledChannel
+    """
+    key = (server_host, server_port)
+    with _channels_lock:
+        pooled = _channels.get(key)
+        if pooled is None or not pooled.is_healthy():
+            if pooled is not None:
+                pooled.close()
+            pooled = PooledChannel(server_host, server_port)
+            _channels[key] = pooled
+        return pooled
+
+
+def _evict_channel(server_host, server_port, pooled):
+    with _channels_lock:
+        if _channels.get((server_host, server_port)) is pooled:
+            del _channels[(server_host, server_port)]
+    pooled.close()
+
+
+def predict(request, server_host, server_port, timeout):
+    """
+    Send a PredictRequest over the pooled channel, reconnecting once if the
+    server became unavailable
+
+    :return: the PredictResponse
+    """
+    pooled = get_channel(server_host, server_port)
+    try:
+        result = pooled.stub.Predict(request, timeout=timeout)
+    except grpc.RpcError as e:
+        if e.code() != grpc.StatusCode.UNAVAILABLE:
+            raise
+        _evict_channel(server_host, server_port, pooled)
+        result = get_channel(server_host, server_port).stub.Predict(request, timeout=timeout)
+    model = (server_host, server_port, request.model_spec.name)
+    _model_versions[model] = result.model_spec.version.value
+    return result
+
+
+def get_model_version(server_host, server_port, server_name):
+    """
+    Return the model version reported by the last response of a model server
+
+    :return: the version number, or None if no prediction was made yet
+    """
+    return _model_versions.get((server_host, server_port, server_name))
+
+
+def make_predict_request(features, server_name, signature_name=TENSOR_SIGNATURE_NAME):
+    """
+    Build a request scoring a batch of transactions
+
+    :param features:       the annonymised transaction features, of shape [N, num_features]
+    :param server_name:    the name of the server
+    :param signature_name: TENSOR_SIGNATURE_NAME to send the features as a float32 tensor,
+                           or CSV_SIGNATURE_NAME to send them as CSV lines
+    :return:               the PredictRequest
+    """
+    request = predict_pb2.PredictRequest()
+    request.model_spec.name = server_name
+    request.model_spec.signature_name = signature_name
+    if signature_name == CSV_SIGNATURE_NAME:
+        inputs = tf.contrib.util.make_tensor_proto(
+            [','.join(str(x) for x in row) for row in features])
+    else:
+        inputs = tf.contrib.util.make_tensor_proto(features, dtype=tf.float32)
+    request.inputs['inputs'].CopyFrom(inputs)
+    return request
+
+
+def is_missing_signature(error):
+    """
+    Tell whether a failed Predict call was rejected because the model has no
+    tensor signature, as models exported before it was added
+
+    :param error: the grpc.RpcError
+    :return:      True if the request should be sent again as CSV
+    """
+    return (error.code() in (grpc.StatusCode.FAILED_PRECONDITION,
+                             grpc.StatusCode.INVALID_ARGUMENT) and
+            TENSOR_SIGNATURE_NAME in (error.details() or ''))
+
+
+def parse_predict_response(result):
+    """
+    Read the predicted classes and confidence scores from a PredictResponse
+
+    :param result: the PredictResponse
+    :return 0:     the class predicted for each transaction, as a list of str for
+                   string labels
+    :return 1:     the confidence scores for all classes, of shape [N, num_classes]
+    """
+    # String labels come back as bytes, decoded here so that every route
+    # serves them as text.
+    classes = [c.decode('utf-8') if isinstance(c, bytes) else c
+               for c in tf.make_ndarray(result.outputs['classes']).reshape(-1).tolist()]
+    scores = tf.make_ndarray(result.outputs['probabilities'])
+    return classes, scores
+
+
+def decode_transactions(mimetype, text):
+    """
+    Read a batch of transactions from the body of a request
+
+    The body is either JSON, a list of feature rows or an object with an
+    "instances" list of feature rows, or CSV text with one transaction per
+    line and no header.
+
+    :param mimetype: the content type of the body
+    :param text:     the body
+    :return:         the float32 features, of shape [N, num_features]
+    """
+    if mimetype in ('text/csv', 'text/plain'):
+        return pd.read_csv(io.StringIO(text), header=None, dtype=np.float32).values
+
+    try:
+        body = json.loads(text)
+    except ValueError:
+        body = None
+    if isinstance(body, dict):
+        body = body.get('instances')
+    if not body:
+        raise ValueError('Expected a JSON list of transactions or {"instances": [...]}.')
+    features = np.atleast_2d(np.asarray(body, dtype=np.float32))
+    if features.ndim != 2:
+        raise ValueError('Transactions must be lists of feature values.')
+    return features
+
+
+def get_predictions(features, server_host='127.0.0.1', server_port=8500, timeout=100.0,
+                    server_name='kfdemo-service'):
+    """
+    Retrieve predictions for a batch of transactions in a single request
+
+    :param features:    the annonymised transaction features, of shape [N, num_features]
+    :param server_host: the address of the TensorFlow server
+    :param server_port: the port used by the server
+    :param server_name: the name of the server
+    :param timeout:     the amount of time to wait for the predictions to complete
+    :return 0:          the class predicted for each transaction
+    :return 1:          the confidence scores for all classes, of shape [N, num_classes]
+    """
+    model = (server_host, server_port, server_name)
+    if model not in _csv_models:
+        request = make_predict_request(features, server_name)
+        try:
+            return parse_predict_response(predict(request, server_host, server_port, timeout))
+        except grpc.RpcError as e:
+            if not is_missing_signature(e):
+                raise
+            _csv_models.add(model)
+
+    request = make_predict_request(features, server_name, CSV_SIGNATURE_NAME)
+    result = predict(request, server_host, server_port, timeout)
+    return parse_predict_response(result)
+
+
+def get_prediction(tnx, server_host='127.0.0.1', server_port=8500, timeout=100.0, server_name='kfdemo-service'):
     """
     Retrieve a prediction from a TensorFlow model server
 
-    :param tnx_info:       an annonymised transaction details
+    :param tnx:         the annonymised transaction features as a float array
     :param server_host: the address of the TensorFlow server
     :param server_port: the port used by the server
     :param server_name: the name of the server
@@ -29,46 +270,282 @@ def get_prediction(tnx_info, server_host='127.0.0.1', server_port=8500, timeout=
     :return 0:          the integer predicted in the transaction
     :return 1:          the confidence scores for all classes
     """
+    classes, scores = get_predictions(np.atleast_2d(tnx), server_host, server_port,
+                                      timeout, server_name)
+    return classes[0], scores[0]
 
-    print("connecting to:%s:%i" % (server_host, server_port))
-    # initialize to server connection
-    channel = implementations.insecure_channel(server_host, server_port)
-    stub = prediction_service_pb2.beta_create_PredictionService_stub(channel)
 
-    # build request
-    request = predict_pb2.PredictRequest()
-    request.model_spec.name = server_name
-    request.model_spec.signature_name = 'predict'
-    request.inputs['inputs'].CopyFrom(
-        tf.contrib.util.make_tensor_proto(tnx_info))
+class _PendingPrediction(object):
+    """A single transaction waiting in a PredictionBatcher."""
 
-    # retrieve results
-    result = stub.Predict(request, timeout)
-    resultVal = result.outputs["classes"].string_val[0]
-    scores = result.outputs['probabilities'].float_val
-    return resultVal, scores
+    def __init__(self, tnx, key, timeout):
+        self.tnx = tnx
+        self.key = key
+        self.timeout = timeout
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
 
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
 
-def random_transaction():
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def wait(self, timeout):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for a batched prediction.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class PredictionBatcher(object):
+    """
+    Coalesces concurrent single transaction predictions into batched requests
+
+    A dispatcher thread collects the transactions queued by concurrent callers
+    of predict(), groups them by model server, and sends each group as one
+    tensor. While no request is in flight, a lone transaction is sent right
+    away, so batching only adds latency when the server is already busy.
+    """
+
+    def __init__(self, max_batch_size=64, max_delay_ms=5, max_in_flight=4):
+        """
+        :param max_batch_size: the maximum number of transactions per request
+        :param max_delay_ms:   how long to collect transactions before sending
+        :param max_in_flight:  the number of batched requests sent concurrently
+        """
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay_ms / 1000.0
+        self._queue = queue.Queue()
+        self._senders = ThreadPool(max_in_flight)
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        dispatcher = threading.Thread(target=self._dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    def predict(self, tnx, server_host='127.0.0.1', server_port=8500, timeout=100.0,
+                server_name='kfdemo-service'):
+        """
+        Retrieve a prediction as part of a batched request, see get_prediction
+
+        :return 0: the integer predicted in the transaction
+        :return 1: the confidence scores for all classes
+        """
+        pending = _PendingPrediction(tnx, (server_host, server_port, server_name), timeout)
+        self._queue.put(pending)
+        return pending.wait(timeout + self._max_delay)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        with self._in_flight_lock:
+            idle = self._in_flight == 0
+        if idle and self._queue.empty():
+            return batch
+        deadline = time.time() + self._max_delay
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _dispatch(self):
+        while True:
+            groups = collections.OrderedDict()
+            for pending in self._collect():
+                groups.setdefault(pending.key, []).append(pending)
+            for pendings in groups.values():
+                with self._in_flight_lock:
+                    self._in_flight += 1
+                self._senders.apply_async(self._send, (pendings,))
+
+    def _send(self, pendings):
+        server_host, server_port, server_name = pendings[0].key
+        try:
+            features = np.stack([pending.tnx for pending in pendings])
+            timeout = max(pending.timeout for pending in pendings)
+            classes, scores = get_predictions(features, server_host, server_port,
+                                              timeout, server_name)
+        except Exception as e:  # pylint: disable=broad-except
+            for pending in pendings:
+                pending.set_exception(e)
+        else:
+            for i, pending in enumerate(pendings):
+                pending.set_result((classes[i], scores[i]))
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+
+class PredictionCache(object):
+    """
+    Bounded LRU cache of predictions keyed on the transaction features
+
+    Entries are keyed on a digest of the float32 feature values together with
+    the model server and model name. Each entry remembers the model version
+    it was predicted with, and is dropped once a response reports a different
+    version for that model, or after ttl seconds.
+
+    Only responses to requests that reach the model server report its
+    version, and cache hits don't make any. A newly deployed model version
+    is therefore noticed on the next miss, and while every lookup hits,
+    entries of the previous version are served for up to ttl seconds: ttl is
+    the bound on how stale a cached prediction can be.
     """
-    Generating a random transaction from test file
-    :return: Strin value of a Random Transaction
+
+    def __init__(self, max_size=10000, ttl=300):
+        """
+        :param max_size: the maximum number of cached predictions
+        :param ttl:      the number of seconds a prediction stays cached
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def predict(self, predict_fn, tnx, server_host='127.0.0.1', server_port=8500,
+                timeout=100.0, server_name='kfdemo-service'):
+        """
+        Return the cached prediction of a transaction, or retrieve and cache it
+        with predict_fn, which has the signature of get_prediction
+
+        :return 0: the integer predicted in the transaction
+        :return 1: the confidence scores for all classes
+        """
+        result = self.get(tnx, server_host, server_port, server_name)
+        if result is None:
+            result = predict_fn(tnx, server_host=server_host, server_port=server_port,
+                                timeout=timeout, server_name=server_name)
+            self.put(tnx, result, server_host, server_port, server_name)
+        return result
+
+    @staticmethod
+    def _key(tnx, server_host, server_port, server_name):
+        digest = hashlib.sha1(np.ascontiguousarray(tnx, dtype=np.float32).tobytes()).hexdigest()
+        return (server_host, server_port, server_name, digest)
+
+    def get(self, tnx, server_host='127.0.0.1', server_port=8500, server_name='kfdemo-service'):
+        """
+        Return the cached prediction of a transaction, for callers that cannot
+        pass a predict_fn, like the asyncio server
+
+        :return: the prediction stored by put, or None on a miss
+        """
+        key = self._key(tnx, server_host, server_port, server_name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if (entry is not None and entry[0] > time.time() and
+                    entry[1] == get_model_version(*key[:3])):
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        return None
+
+    def put(self, tnx, result, server_host='127.0.0.1', server_port=8500,
+            server_name='kfdemo-service'):
+        """
+        Cache the prediction of a transaction, made with the model version
+        reported by the last response of the model server
+        """
+        key = self._key(tnx, server_host, server_port, server_name)
+        with self._lock:
+            self._entries[key] = (time.time() + self._ttl, get_model_version(*key[:3]), result)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the cache counters
+
+        :return: a dict with the size, hits, misses and hit rate of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+
+def convert_samples(csv_path, output_dir):
+    """
+    Convert a test CSV file into the binary sample format read by load_samples
+
+    :param csv_path:   the test CSV file with ID_code, target and feature columns
+    :param output_dir: the directory receiving features.npy and target.npy
     """
-    data = pd.read_csv('/home/test.csv')
+    header = pd.read_csv(csv_path, nrows=0).columns
+    feature_columns = [x for x in header if x not in ('ID_code', 'target')]
+    data = pd.read_csv(csv_path, usecols=feature_columns + ['target'],
+                       dtype=dict((x, np.float32) for x in feature_columns))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    np.save(os.path.join(output_dir, 'target.npy'), data.pop('target').values.astype(np.int8))
+    np.save(os.path.join(output_dir, 'features.npy'), data.values)
 
-    # Generating random number between 0 and 200
-    tnx_index = random.randint(0, 200)
 
-    # Getting the actual target for the transactions
-    target = data.iloc[tnx_index]['target']
+def load_samples(path, pool_size):
+    """
+    Load the pool of test transactions the demo samples from
+
+    :param path:      a test CSV file, or a directory written by convert_samples
+                      whose arrays are memory-mapped rather than read
+    :param pool_size: the number of leading transactions in the pool
+    :return 0:        the float32 features, of shape [pool_size, num_features]
+    :return 1:        the targets, of shape [pool_size]
+    """
+    if os.path.isdir(path):
+        features = np.load(os.path.join(path, 'features.npy'), mmap_mode='r')
+        target = np.load(os.path.join(path, 'target.npy'), mmap_mode='r')
+        return features[:pool_size], target[:pool_size]
+
+    header = pd.read_csv(path, nrows=0).columns
+    feature_columns = [x for x in header if x not in ('ID_code', 'target')]
+    data = pd.read_csv(path, nrows=pool_size, usecols=feature_columns + ['target'],
+                       dtype=dict((x, np.float32) for x in feature_columns))
+    target = data.pop('target').values
+    return data.values, target
+
+
+def get_samples():
+    """
+    Return the sample pool, loading it on first use
+
+    :return: the features and targets returned by load_samples
+    """
+    global _samples
+    if _samples is None:
+        with _samples_lock:
+            if _samples is None:
+                _samples = load_samples(SAMPLES_PATH, SAMPLE_POOL_SIZE)
+    return _samples
+
+
+def random_transaction():
+    """
+    Picking a random transaction from the sample pool
+    :return: Float32 features of a Random Transaction and its target
+    """
+    features, target = get_samples()
 
-    # Dropping ID and target columns
-    data.drop(['ID_code', 'target'], axis=1, inplace=True)
+    tnx_index = random.randrange(len(features))
 
-    # Getting the required row in the data
-    tnx = data.iloc[tnx_index].values
+    return features[tnx_index], target[tnx_index]
 
-    # Convert the row into CS String value
-    tnx_info = [','.join(str(e) for e in tnx)]
 
-    return tnx_info, target
+if __name__ == '__main__':
+    # python ctp_client.py test.csv samples/
+    convert_samples(sys.argv[1], sys.argv[2])
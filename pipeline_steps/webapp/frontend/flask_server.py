@@ -1,10 +1,29 @@
 import logging
+import os
 
-from flask import Flask, render_template, request
-from ctp_client import get_prediction, random_transaction
+from flask import Flask, jsonify, render_template, request
+from ctp_client import (PredictionBatcher, PredictionCache, decode_transactions, get_model_version,
+                        get_prediction, get_predictions, get_samples, random_transaction)
 
 app = Flask(__name__)
 
+# Concurrent page loads are coalesced into batched predictions when
+# MICRO_BATCH_DELAY_MS is set to a positive number of milliseconds.
+MICRO_BATCH_DELAY_MS = float(os.environ.get('MICRO_BATCH_DELAY_MS', '0'))
+MICRO_BATCH_SIZE = int(os.environ.get('MICRO_BATCH_SIZE', '64'))
+batcher = None
+if MICRO_BATCH_DELAY_MS > 0:
+    batcher = PredictionBatcher(max_batch_size=MICRO_BATCH_SIZE,
+                                max_delay_ms=MICRO_BATCH_DELAY_MS)
+
+# Predictions of repeated transactions are served from an LRU cache of
+# PREDICTION_CACHE_SIZE entries, expiring after PREDICTION_CACHE_TTL seconds.
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', '10000'))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', '300'))
+cache = None
+if PREDICTION_CACHE_SIZE > 0:
+    cache = PredictionCache(max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL)
+
 
 # handle requests to the server
 @app.route("/")
@@ -21,20 +40,27 @@ def main():
     try:
 
         # Get random transaction
-        tnx_info, target = random_transaction()
+        tnx, target = random_transaction()
         # get prediction from TensorFlow server
-        pred, scores = get_prediction(tnx_info, server_host=addr_arg,
+        predict_fn = batcher.predict if batcher else get_prediction
+        if cache:
+            pred, scores = cache.predict(predict_fn, tnx, server_host=addr_arg,
+                                         server_port=int(port_arg),
+                                         timeout=10, server_name=name_arg)
+        else:
+            pred, scores = predict_fn(tnx, server_host=addr_arg,
                                       server_port=int(port_arg),
                                       timeout=10, server_name=name_arg)
         # if no exceptions thrown, server connection was a success
-        connection["text"] = "Connected (model version: " + str(1) + ")"
+        version = get_model_version(addr_arg, int(port_arg), name_arg)
+        connection["text"] = "Connected (model version: " + str(version) + ")"
         connection["success"] = True
         # parse class confidence scores from server prediction
         scores_dict = []
         for i in range(0, 2):
             scores_dict += [{"index": str(i), "val": scores[i]}]
         output = {"truth": target, "prediction": pred,
-                  "tnx_info": tnx_info, "scores": scores_dict}
+                  "tnx_info": ','.join(map(str, tnx)), "scores": scores_dict}
     except Exception as e:  # pylint: disable=broad-except
         logging.info("Exception occured: %s", e)
         # server connection failed
@@ -44,6 +70,52 @@ def main():
                            connection=connection, args=args)
 
 
+def parse_transactions(req):
+    """
+    Read a batch of transactions from the body of a Flask request
+
+    :param req: the Flask request
+    :return:    the float32 features, of shape [N, num_features]
+    """
+    return decode_transactions(req.mimetype, req.get_data(as_text=True))
+
+
+# score many transactions with one batched request to the model server
+@app.route("/predict", methods=['POST'])
+def predict_batch():
+    name_arg = request.args.get('name', 'kfdemo-service')
+    addr_arg = request.args.get('addr', 'kfdemo-service')
+    port_arg = request.args.get('port', '9000')
+
+    try:
+        features = parse_transactions(request)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        classes, scores = get_predictions(features, server_host=addr_arg,
+                                          server_port=int(port_arg),
+                                          timeout=10, server_name=name_arg)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.info("Exception occured: %s", e)
+        return jsonify({"error": "Exception making request: {0}".format(e)}), 502
+
+    predictions = []
+    for pred, row_scores in zip(classes, scores):
+        predictions.append({"class": pred, "probabilities": row_scores.tolist()})
+    return jsonify({"predictions": predictions})
+
+
+# report the prediction cache counters
+@app.route("/cache")
+def cache_stats():
+    if not cache:
+        return jsonify({"enabled": False})
+    stats = cache.stats()
+    stats["enabled"] = True
+    return jsonify(stats)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO,
                         format=('%(levelname)s|%(asctime)s'
@@ -51,5 +123,7 @@ if __name__ == '__main__':
                         datefmt='%Y-%m-%dT%H:%M:%S',
                         )
     logging.getLogger().setLevel(logging.INFO)
+    logging.info("Loading sample transactions.")
+    get_samples()
     logging.info("Starting flask.")
     app.run(debug=False, port=8080, host='0.0.0.0')
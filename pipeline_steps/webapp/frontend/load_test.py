@@ -0,0 +1,90 @@
+# !/usr/bin/env python2.7
+
+"""Sends concurrent requests to the frontend and reports latency percentiles.
+
+A comma separated concurrency runs one round per level, which shows how the
+throughput of the Flask and the ASGI serving modes scales with the number of
+concurrent clients.
+
+Usage:
+  python load_test.py --url "http://localhost:8080/?addr=kfdemo-service&port=9000" \
+      --requests 500 --concurrency 1,8,32,128
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+import numpy as np
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://localhost:8080/',
+                        help='URL of the frontend page to load.')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Total number of requests to send.')
+    parser.add_argument('--concurrency', type=str, default='16',
+                        help='Comma separated numbers of concurrent clients, one round each.')
+    return parser.parse_args()
+
+
+def run(url, num_requests, concurrency):
+    """
+    Load the url num_requests times from concurrency threads
+
+    :return 0: the latencies of the successful requests in milliseconds
+    :return 1: the number of failed requests
+    :return 2: the wall time of the whole run in seconds
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [num_requests]
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                urlopen(url).read()
+                elapsed = (time.time() - start) * 1000
+                with lock:
+                    latencies.append(elapsed)
+            except Exception:  # pylint: disable=broad-except
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.time() - start
+
+
+def main():
+    args = parse_arguments()
+    for concurrency in [int(x) for x in args.concurrency.split(',')]:
+        latencies, errors, wall_time = run(args.url, args.requests, concurrency)
+        print('requests: %d  errors: %d  concurrency: %d' % (args.requests, errors, concurrency))
+        print('throughput: %.1f req/s' % (len(latencies) / wall_time))
+        if latencies:
+            print('latency p50: %.1f ms  p99: %.1f ms' % (
+                np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+    main()
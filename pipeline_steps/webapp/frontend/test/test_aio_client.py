@@ -0,0 +1,143 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests of the asyncio client. The fake server builds its responses with
+tf.contrib, so they run with the TF 1.13 of the webapp image and are skipped
+with releases that no longer have it."""
+
+import aio_client
+import asyncio
+import grpc
+import numpy as np
+import tensorflow as tf
+import unittest
+from tensorflow_serving.apis import predict_pb2
+
+
+class FakeRpcError(grpc.RpcError):
+
+  def __init__(self, code, details=''):
+    self._code = code
+    self._details = details
+
+  def code(self):
+    return self._code
+
+  def details(self):
+    return self._details
+
+
+class FakeStub(object):
+  """A PredictionService stub with the call signature of grpc.aio, where
+  the timeout is keyword only."""
+
+  def __init__(self, errors=()):
+    self.errors = list(errors)
+    self.timeouts = []
+    self.signatures = []
+
+  async def Predict(self, request, *, timeout=None):
+    self.timeouts.append(timeout)
+    self.signatures.append(request.model_spec.signature_name)
+    if self.errors:
+      raise self.errors.pop(0)
+    num_rows = tf.make_ndarray(request.inputs['inputs']).shape[0]
+    response = predict_pb2.PredictResponse()
+    response.model_spec.name = request.model_spec.name
+    response.model_spec.version.value = 3
+    response.outputs['classes'].CopyFrom(
+        tf.contrib.util.make_tensor_proto(np.array([b'1'] * num_rows)))
+    response.outputs['probabilities'].CopyFrom(
+        tf.contrib.util.make_tensor_proto(np.tile([0.25, 0.75], (num_rows, 1)),
+                                          dtype=tf.float32))
+    return response
+
+
+@unittest.skipUnless(hasattr(tf, 'contrib'), 'needs tf.contrib, as in TF 1.13')
+class TestAioClient(unittest.TestCase):
+
+  def setUp(self):
+    self.get_stub = aio_client.get_stub
+    self.evict_stub = aio_client._evict_stub
+    self.evicted = []
+    aio_client._csv_models.clear()
+    aio_client._evict_stub = lambda host, port, stub: self.evicted.append(stub)
+
+  def tearDown(self):
+    aio_client.get_stub = self.get_stub
+    aio_client._evict_stub = self.evict_stub
+
+  def run_with_stubs(self, coroutine, stubs):
+    stubs = list(stubs)
+    aio_client.get_stub = lambda host, port: stubs[0] if len(stubs) == 1 else stubs.pop(0)
+    return asyncio.run(coroutine)
+
+  def test_get_predictions(self):
+    stub = FakeStub()
+    features = np.zeros((3, 200), dtype=np.float32)
+    classes, scores = self.run_with_stubs(
+        aio_client.get_predictions(features, 'localhost', 9000, timeout=5.0), [stub])
+    self.assertEqual(['1', '1', '1'], classes)
+    self.assertEqual((3, 2), scores.shape)
+    self.assertEqual([5.0], stub.timeouts)
+    self.assertEqual(3, aio_client._model_versions[('localhost', 9000, 'kfdemo-service')])
+
+  def test_get_prediction_reconnects_when_unavailable(self):
+    failed = FakeStub([FakeRpcError(grpc.StatusCode.UNAVAILABLE)])
+    stub = FakeStub()
+    pred, scores = self.run_with_stubs(
+        aio_client.get_prediction(np.zeros(200, dtype=np.float32), 'localhost', 9000,
+                                  timeout=2.0), [failed, stub])
+    self.assertEqual('1', pred)
+    self.assertEqual(2, len(scores))
+    self.assertEqual([failed], self.evicted)
+    self.assertEqual([2.0], failed.timeouts)
+    self.assertEqual([2.0], stub.timeouts)
+
+  def test_other_errors_are_raised(self):
+    stub = FakeStub([FakeRpcError(grpc.StatusCode.DEADLINE_EXCEEDED)])
+    with self.assertRaises(grpc.RpcError):
+      self.run_with_stubs(
+          aio_client.get_predictions(np.zeros((1, 200), dtype=np.float32),
+                                     'localhost', 9000, timeout=1.0), [stub])
+
+  def test_models_without_tensor_signature_are_sent_csv(self):
+    missing = FakeRpcError(grpc.StatusCode.FAILED_PRECONDITION,
+                           'Serving signature key "tensor:predict" not found.')
+    stub = FakeStub([missing])
+    features = np.zeros((2, 200), dtype=np.float32)
+    for _ in range(2):
+      classes, _ = self.run_with_stubs(
+          aio_client.get_predictions(features, 'localhost', 9000, timeout=1.0), [stub])
+      self.assertEqual(['1', '1'], classes)
+    self.assertEqual(['tensor:predict', 'predict', 'predict'], stub.signatures)
+
+  def test_batcher_coalesces_concurrent_predictions(self):
+    stub = FakeStub()
+    batcher = aio_client.PredictionBatcher(max_batch_size=8, max_delay_ms=50)
+
+    async def predict_all():
+      # The first transaction is sent alone, the others wait for it.
+      return await asyncio.gather(*[
+          batcher.predict(np.full(200, i, dtype=np.float32), 'localhost', 9000, timeout=1.0)
+          for i in range(5)])
+
+    results = self.run_with_stubs(predict_all(), [stub])
+    self.assertEqual(['1'] * 5, [pred for pred, _ in results])
+    self.assertEqual(2, len(stub.timeouts))
+
+
+if __name__ == '__main__':
+  unittest.main()
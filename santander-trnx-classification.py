@@ -60,6 +60,7 @@ def santander_transaction_classification(
         gcp_project=project,
         run_mode=mode,
         preprocessing_module=preprocess_module,
+        cache_dir=str(output) + '/cache/preprocess',
         transformed_data_dir=output_template
     )
 
@@ -92,6 +93,8 @@ def santander_transaction_classification(
     roc = roc_op(
         predictions_dir=prediction.outputs['predictions_dir'],
         target_lambda=target_class_lambda,
+        num_bins=1000,
+        metrics='roc,pr,f1,lift',
         output_dir=output_template
     )
 